@@ -0,0 +1,54 @@
+# Micro-benchmark: the dict-based WSClient.message_down() + serialization versus the precompiled payload_builders fast path.
+# Nothing is sent; both paths stop at the JSON string that would go on the outbound queue.
+# Usage, from the src folder (so that this tree's moobius is imported): PYTHONPATH=. python benchmarks/bench_payload_builders.py [n_messages] [json_codec]
+
+import asyncio, json, sys, time, uuid
+
+from loguru import logger
+
+from moobius import types
+from moobius.network import payload_builders
+from moobius.network.ws_client import WSClient
+from moobius.types import MessageContent
+
+
+def _strip_volatile(frame):
+    """Parses a frame and drops the fields that differ on every call. Returns the dict."""
+    message = json.loads(frame)
+    del message['request_id']
+    del message['body']['timestamp']
+    return message
+
+
+async def main(n, json_codec):
+    """Times n messages down each way (both including the request_id and timestamp) and prints the results. Returns None."""
+    logger.remove()
+    ws_client = WSClient('ws://localhost:0', json_codec=json_codec)
+    dumps = ws_client.codec.dumps
+    args = ('service_id', 'service_id', 'channel_id', 'group_id', types.TEXT)
+    contents = [MessageContent(text=f'Hello number {i}, how are you today?') for i in range(n)]
+
+    # Check the two paths agree before timing them:
+    old = dumps(await ws_client.message_down(*args, contents[0], 'sender_id', dry_run=True))
+    new = payload_builders.builder_for(types.MESSAGE_DOWN, types.TEXT).build('x', None, 'service_id', 'channel_id', 'group_id', contents[0], 0, None, 'sender_id', dumps)
+    assert _strip_volatile(old) == _strip_volatile(new), (old, new)
+    assert list(json.loads(old)) == list(json.loads(new)) # Same key order.
+
+    t0 = time.perf_counter()
+    for content in contents:
+        dumps(await ws_client.message_down(*args, content, 'sender_id', dry_run=True))
+    t_dict = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for content in contents:
+        builder = payload_builders.builder_for(types.MESSAGE_DOWN, types.TEXT)
+        builder.build(str(uuid.uuid4()), None, 'service_id', 'channel_id', 'group_id', content, int(time.time()*1000), None, 'sender_id', dumps)
+    t_fast = time.perf_counter() - t0
+
+    print(f'codec={ws_client.codec.name} n={n}')
+    print(f'  dict path:    {1e6*t_dict/n:7.2f} us/message')
+    print(f'  builder path: {1e6*t_fast/n:7.2f} us/message ({t_dict/t_fast:.1f}x)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, sys.argv[2] if len(sys.argv) > 2 else 'auto'))
@@ -0,0 +1,92 @@
+# Benchmark: HTTPAPIWrapper.download() as one stream versus several parallel ranges, against a local aiohttp server.
+# The server caps each connection's speed (like a real per-stream bottleneck) and can drop connections part way through to exercise resuming.
+# Usage, from the src folder (so that this tree's moobius is imported): PYTHONPATH=. python benchmarks/bench_ranged_download.py [size_mb] [per_connection_mb_per_s] [n_parallel] [n_resets]
+
+import asyncio, hashlib, os, sys, tempfile, time
+
+from aiohttp import web
+from loguru import logger
+
+from moobius.network.http_api_wrapper import HTTPAPIWrapper
+
+
+def make_app(data, bytes_per_s, n_resets):
+    """Returns an aiohttp app serving data at /file.bin with Range and ETag support, at most bytes_per_s per connection,
+    and the first n_resets responses cut off half way."""
+    etag = '"' + hashlib.md5(data).hexdigest() + '"'
+    resets = [n_resets]
+
+    async def head(request):
+        return web.Response(headers={'Content-Length': str(len(data)), 'Accept-Ranges': 'bytes', 'ETag': etag})
+
+    async def get(request):
+        start, end, status = 0, len(data), 200
+        rng = request.headers.get('Range')
+        if rng and request.headers.get('If-Range', etag) == etag:
+            first, _, last = rng.split('=')[1].partition('-')
+            start, end, status = int(first), (int(last)+1 if last else len(data)), 206
+            if start >= len(data):
+                return web.Response(status=416)
+        response = web.StreamResponse(status=status, headers={'Content-Length': str(end-start), 'Accept-Ranges': 'bytes', 'ETag': etag})
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{end-1}/{len(data)}'
+        await response.prepare(request)
+        cut = (start+end)//2 if resets[0] > 0 else None
+        if cut is not None:
+            resets[0] -= 1
+        chunk = 1<<16
+        for pos in range(start, end, chunk):
+            if cut is not None and pos >= cut:
+                request.transport.close() # Drop the connection mid-body.
+                return response
+            await response.write(data[pos:min(end, pos+chunk)])
+            await asyncio.sleep(chunk/bytes_per_s)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_route('HEAD', '/file.bin', head)
+    app.router.add_get('/file.bin', get, allow_head=False)
+    return app
+
+
+async def main(size_mb, mb_per_s, n_parallel, n_resets):
+    """Downloads the file once per mode, checks the bytes, and prints the times. Returns None."""
+    logger.remove()
+    data = os.urandom(int(size_mb*(1<<20)))
+    runner = web.AppRunner(make_app(data, mb_per_s*(1<<20), 0))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 8771).start()
+    http_api = HTTPAPIWrapper('http://127.0.0.1:8771', download_parallel_min_size=1<<20, retry_base_delay=0.01)
+    url = 'http://127.0.0.1:8771/file.bin'
+    out_dir = tempfile.mkdtemp()
+    try:
+        for parallel in [1, n_parallel]:
+            t0 = time.perf_counter()
+            path = await http_api.download(url, file_path=f'{out_dir}/p{parallel}.bin', parallel=parallel)
+            elapsed = time.perf_counter() - t0
+            with open(path, 'rb') as f:
+                assert f.read() == data
+            print(f'parallel={parallel}: {elapsed:.2f}s ({size_mb/elapsed:.1f} MB/s)')
+    finally:
+        await runner.cleanup()
+
+    runner = web.AppRunner(make_app(data, mb_per_s*(1<<20), n_resets))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 8771).start()
+    try:
+        t0 = time.perf_counter()
+        path = await http_api.download(url, file_path=f'{out_dir}/resumed.bin', parallel=1)
+        elapsed = time.perf_counter() - t0
+        with open(path, 'rb') as f:
+            assert f.read() == data
+        print(f'parallel=1 with {n_resets} dropped connections: {elapsed:.2f}s (resumed from the .part file each time)')
+    finally:
+        await runner.cleanup()
+        await http_api.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    asyncio.run(main(float(args[0]) if len(args) > 0 else 32, float(args[1]) if len(args) > 1 else 16,
+                     int(args[2]) if len(args) > 2 else 4, int(args[3]) if len(args) > 3 else 2))
@@ -21,7 +21,7 @@ class ServiceGroupLib():
         self.ids2id_mdown = {}
         self.id2ids_mup = {}
         self.ids2id_mup = {}
-        self.alock = asyncio.Lock()
+        self._creating = {} # (is_message_down, joined ids) => Task creating that group, so that concurrent conversions of the same list create it only once.
 
     async def convert_list(self, http_api, character_ids, is_message_down, channel_id=None):
         """
@@ -41,28 +41,40 @@ class ServiceGroupLib():
         else:
             ids2id = self.id2ids_mup
             id2ids = self.id2ids_mup
-        async with self.alock: # Make sure the old list is stored before the new list is created.
-            character_ids = types.to_char_id_list(character_ids)
-            #if restrict_to_these_valid_ids:
-            #    character_ids = [c_id for c_id in character_ids if c_id in set(restrict_to_these_valid_ids)]
-            if len(character_ids) == 0:
-                return None
-            else: # Convert list to a single group id in this mode.
-                massive_str = '_'.join(character_ids)
-                need_new_group = massive_str not in ids2id
-                if need_new_group: # Call /service/group/create
-                    character_ids = character_ids.copy()
-                    if is_message_down:
-                        group_id = (await http_api.create_service_group(character_ids)).group_id
-                    else:
-                        if not channel_id:
-                            raise Exception('A channel_id must be specified when is_message_down is False')
-                        group_id = (await http_api.create_channel_group(channel_id, 'A_message_up_group', character_ids)).group_id
-                    ids2id[massive_str] = group_id
-                    id2ids[group_id] = character_ids
-                out = ids2id[massive_str]
-                logger.info(f'Converted recipient list (is_mdown={is_message_down}) {character_ids} to group id {out} on process {os.getpid()}. {"Created new service group." if need_new_group else "Group already exists."}')
-                return out
+        character_ids = types.to_char_id_list(character_ids)
+        #if restrict_to_these_valid_ids:
+        #    character_ids = [c_id for c_id in character_ids if c_id in set(restrict_to_these_valid_ids)]
+        if len(character_ids) == 0:
+            return None
+        # Convert list to a single group id in this mode.
+        massive_str = '_'.join(character_ids)
+        need_new_group = massive_str not in ids2id
+        if need_new_group: # Call /service/group/create
+            # Single-flight per list: the first caller starts a Task that creates the group, concurrent callers with the same list await that Task,
+            # and callers with different lists create their groups at the same time.
+            creating_key = (is_message_down, massive_str)
+            task = self._creating.get(creating_key)
+            if task is None:
+                async def _create(character_ids):
+                    """Creates the group and stores it. Returns the group id."""
+                    try:
+                        if is_message_down:
+                            group_id = (await http_api.create_service_group(character_ids)).group_id
+                        else:
+                            if not channel_id:
+                                raise Exception('A channel_id must be specified when is_message_down is False')
+                            group_id = (await http_api.create_channel_group(channel_id, 'A_message_up_group', character_ids)).group_id
+                        ids2id[massive_str] = group_id
+                        id2ids[group_id] = character_ids
+                        return group_id
+                    finally:
+                        del self._creating[creating_key]
+                task = asyncio.ensure_future(_create(character_ids.copy()))
+                self._creating[creating_key] = task
+            await asyncio.shield(task)
+        out = ids2id[massive_str]
+        logger.info(f'Converted recipient list (is_mdown={is_message_down}) {character_ids} to group id {out} on process {os.getpid()}. {"Created new service group." if need_new_group else "Group already exists."}')
+        return out
 
 
 async def group2ids(group_id, payload_body, http_api, client_id):
@@ -5,7 +5,7 @@
 # And much, much more.
 # Override the Moobius class to implement your service.
 
-import json, os, sys, asyncio, json, uuid, aioprocessing
+import json, os, sys, asyncio, json, uuid, aioprocessing, functools
 from typing import Optional
 import dataclasses
 from dataclasses import asdict
@@ -17,6 +17,7 @@ from loguru import logger
 from moobius import types, json_utils, quickstart
 from moobius.core import groups
 from moobius.network.ws_client import WSClient
+from moobius.network.ws_pool import WSClientPool
 from moobius.network.http_api_wrapper import HTTPAPIWrapper
 from moobius.types import MessageContent, MessageBody, Button, ButtonClick, InputComponent, Payload, MenuItemClick, UpdateBody, UpdateItem, CopyBody, Character, ChannelInfo, CanvasItem, StyleItem, MenuItem, ClickArgument, SimpleAction
 from moobius.database.storage import MoobiusStorage
@@ -41,8 +42,12 @@ class Moobius:
           config=None: All the configs. Can be a dict or a JSON filename.
           account_config=None: Config specific to the account. Can be a dict or a JSON filename. Overrides config.
           service_config=None: Config specific to launching the service. Can be a dict or a JSON filename. Overrides config.
+            The optional "ws_options" dict inside of it is passed as extra kwargs to the WSClient (for example {"batch_max_frames": 256}).
+            Likewise the optional "http_options" dict is passed as extra kwargs to the HTTPAPIWrapper (for example {"json_codec": "orjson", "response_cache": True}).
+            The optional "ws_connections" int (service mode only, default 1) spreads the channels over that many separately logged-in sockets.
           db_config=None: Config that sepecifies a per-channel MoobiusStorage object stored in self.channels. Can be a dict or a JSON filename. Overrides config.
           log_config=None: Config that is log-related.
+            The optional "traffic_log" dict inside of it sets how socket frames are logged (for example {"max_chars": 512, "sample_rates": {"update": 0.1}}).
 
         Example:
           >>> service = SDK(account_config={}, log_config={})
@@ -62,8 +67,22 @@ class Moobius:
         self.channels = {} # Generally filled up when initializing a channel.
         self.group_lib = groups.ServiceGroupLib()
 
-        self.http_api = HTTPAPIWrapper(self.config['service_config']['http_server_uri'], self.config['account_config']['email'], self.config['account_config']['password'])
-        self.ws_client = WSClient(self.config['service_config']['ws_server_uri'], on_connect=self.send_service_login if self.service_mode else self.send_user_login, handle=self.handle_received_payload, report_str='' if self.service_mode else ' (user-mode)')
+        http_options = self.config['service_config'].get('http_options', {}) # Extra HTTPAPIWrapper kwargs.
+        self.http_api = HTTPAPIWrapper(self.config['service_config']['http_server_uri'], self.config['account_config']['email'], self.config['account_config']['password'], **http_options)
+        ws_options = {'traffic_log': self.config['log_config'].get('traffic_log'), **self.config['service_config'].get('ws_options', {})} # Extra WSClient kwargs, such as batching and queue settings.
+        n_connections = max(1, int(self.config['service_config'].get('ws_connections', 1))) if self.service_mode else 1
+        ws_clients = []
+        for i in range(n_connections):
+            shard_options = dict(ws_options)
+            if i > 0 and shard_options.get('journal_dir'): # Each socket needs its own journal.
+                shard_options['journal_dir'] = os.path.join(shard_options['journal_dir'], f'shard{i}')
+            report_str = ('' if self.service_mode else ' (user-mode)') + (f' [{i}]' if n_connections > 1 else '')
+            ws_client = WSClient(self.config['service_config']['ws_server_uri'], report_str=report_str, **shard_options)
+            ws_client.on_connect = functools.partial(self.send_service_login if self.service_mode else self.send_user_login, ws_client) # Each socket logs itself in.
+            ws_client.handle = functools.partial(self.handle_received_payload, ws_client=ws_client) # So that a failed copy is answered on the socket it came from.
+            ws_clients.append(ws_client)
+        self.ws_pool = WSClientPool(ws_clients) # Channels are hash-partitioned across these. Use self._ws_for(channel_id) to pick one.
+        self.ws_client = ws_clients[0] # Carries everything that is not for a specific channel.
 
         self.queue = aioprocessing.AioQueue()
 
@@ -146,6 +165,7 @@ class Moobius:
           4. Start the scheduler and run refresh(), authenticate(), and send_heartbeat() periodically.
           5. Call the on_start() callback (override this method to perform your own initialization tasks).
           6. Start listening to the websocket and the Wand.
+        The HTTP session is opened first and closed when this returns or raises.
 
         Returns None.
         """
@@ -153,52 +173,56 @@ class Moobius:
 
         logger.debug("Starting service..." if self.service_mode else "Starting user-mode client...")
 
-        await self.authenticate()
-        await self.ws_client.connect()
-        logger.debug("Connected to websocket server.")
+        await self.http_api.start() # One pooled HTTP session for the service's lifetime.
+        try:
+            await self.authenticate()
+            await self.ws_pool.connect()
+            logger.debug("Connected to websocket server.")
 
-        if self.service_mode:
-            if not self.client_id:
-                logger.debug('No service_id in config file. Will create a new service.')
-                self.client_id = await self.create_new_service()
-                await asyncio.sleep(5) # TODO: Sleeps "long enough" should be replaced with polling.
-            if not self.client_id:
-                raise Exception("Error creating a new service and getting its id.")
-            await self.send_service_login()
-            await asyncio.sleep(1)
-
-            await self.before_channel_init()
-            true_channel_ids = await self.true_channel_list()
-            for channel_id in true_channel_ids:
-                groupid2ids = await self.http_api.fetch_channel_group_dict(channel_id, self.client_id)
-                logger.info(f'The channel {channel_id} has {len(groupid2ids)} groups, adding these to self.group_lib.')
-                self.group_lib.id2ids_mdown = {**self.group_lib.id2ids_mdown, **groupid2ids}
-                self.channels[channel_id] = None
-                await self.on_channel_init(channel_id)
-        else:
-            user_info = await self.http_api.fetch_user_info()
-            self.client_id = user_info.user_id
-            await self.send_user_login()
-            await self.user_join_service_channels()
+            if self.service_mode:
+                if not self.client_id:
+                    logger.debug('No service_id in config file. Will create a new service.')
+                    self.client_id = await self.create_new_service()
+                    await asyncio.sleep(5) # TODO: Sleeps "long enough" should be replaced with polling.
+                if not self.client_id:
+                    raise Exception("Error creating a new service and getting its id.")
+                await self.send_service_login()
+                await asyncio.sleep(1)
+
+                await self.before_channel_init()
+                true_channel_ids = await self.true_channel_list()
+                for channel_id in true_channel_ids:
+                    groupid2ids = await self.http_api.fetch_channel_group_dict(channel_id, self.client_id)
+                    logger.info(f'The channel {channel_id} has {len(groupid2ids)} groups, adding these to self.group_lib.')
+                    self.group_lib.id2ids_mdown = {**self.group_lib.id2ids_mdown, **groupid2ids}
+                    self.channels[channel_id] = None
+                    await self.on_channel_init(channel_id)
+            else:
+                user_info = await self.http_api.fetch_user_info()
+                self.client_id = user_info.user_id
+                await self.send_user_login()
+                await self.user_join_service_channels()
 
-        # Schedulers cannot be serialized so that you have to initialize it here
-        self.scheduler = AsyncIOScheduler()
+            # Schedulers cannot be serialized so that you have to initialize it here
+            self.scheduler = AsyncIOScheduler()
 
-        # The details of access_token and refresh_token are managed by self.http_api
-        self.scheduler.add_job(self.refresh_authentication, 'interval', seconds=self.refresh_interval)
-        self.scheduler.add_job(self.authenticate, 'interval', seconds=self.authenticate_interval)
-        self.scheduler.add_job(self.send_heartbeat, 'interval', seconds=self.heartbeat_interval)
+            # The details of access_token and refresh_token are managed by self.http_api
+            self.scheduler.add_job(self.refresh_authentication, 'interval', seconds=self.refresh_interval)
+            self.scheduler.add_job(self.authenticate, 'interval', seconds=self.authenticate_interval)
+            self.scheduler.add_job(self.send_heartbeat, 'interval', seconds=self.heartbeat_interval)
 
-        if self.checkin_interval > 0:
-            self.scheduler.add_job(logger.catch(self._checkin), 'interval', seconds=self.checkin_interval) # This check-in must be after on_start()
+            if self.checkin_interval > 0:
+                self.scheduler.add_job(logger.catch(self._checkin), 'interval', seconds=self.checkin_interval) # This check-in must be after on_start()
 
-        self.scheduler.start()
-        logger.debug("Scheduler started.")
+            self.scheduler.start()
+            logger.debug("Scheduler started.")
 
-        await self.on_start()
-        logger.debug("on_start() finished.")
+            await self.on_start()
+            logger.debug("on_start() finished.")
 
-        await asyncio.gather(self.ws_client.receive(), self.listen_loop())
+            await asyncio.gather(self.ws_pool.receive(), self.listen_loop())
+        finally:
+            await self.http_api.close()
 
     async def user_join_service_channels(self):
         """Joins service channels given a service config dict or JSON filename (use in user mode). Returns None"""
@@ -282,7 +306,7 @@ class Moobius:
 
     async def send_message(self, message, channel_id=None, sender=None, recipients=None, subtype=None, text=None, path=None, image=None, audio=None, link=None, title=None, button=None, len_limit=None, file_display_name=None, context=None):
         """
-        Sends a message down (or up if in user-mode). This function is very flexible. Returns None.
+        Sends a message down (or up if in user-mode). This function is very flexible. Returns the request_id of the message sent, or None if nothing was sent.
 
         Parameters:
           message: The message to send.
@@ -321,24 +345,25 @@ class Moobius:
             subtype = types.AUDIO
         message = types.normalize_message(message=message, channel_id=channel_id, sender=sender, recipients=recipients, subtype=subtype, len_limit=len_limit, file_display_name=file_display_name, path=path, text=text, link=link, title=title, button=button, context=context)
 
-        # URL handling:
-        if message['content'].path:
-            message['content'].path = await self.http_api.convert_to_url(message['content'].path) # If already a URL will not change it or upload anything.
-            if message['subtype'] == types.FILE and not message['content'].size:
-                message['content'].size = await self.http_api.download_size(message['content'].path)
+        async def _convert_path():
+            """Uploads the content's file, if any (a URL is left as it is), and fills in the size of a file message. Returns None."""
+            if message['content'].path:
+                message['content'].path = (await self.http_api.upload_many([message['content'].path]))[0]
+                if message['subtype'] == types.FILE and not message['content'].size:
+                    message['content'].size = await self.http_api.download_size(message['content'].path)
 
         if message.get('recipients') is not None:
-            message['recipients'] = await self._update_rec(message['recipients'], self.service_mode, message.get('channel_id'))
+            _, message['recipients'] = await asyncio.gather(_convert_path(), self._update_rec(message['recipients'], self.service_mode, message.get('channel_id'))) # Upload while the recipients are resolved.
             if self.service_mode:
                 message['sender'] = message['sender'] or 'no_sender'
 
             if self.service_mode:
-                return await self.ws_client.message_down(self.client_id, self.client_id,  **message)
+                return await self._ws_for(message.get('channel_id')).send_message_down(self.client_id, self.client_id,  **message)
             else:
                 for ky in ['sender', 'timestamp']: # Message up messages have no sender, it is just the user id.
                     if ky in message:
                         del message[ky]
-                return await self.ws_client.message_up(self.client_id, self.client_id, **message)
+                return await self._ws_for(message.get('channel_id')).send_message_up(self.client_id, self.client_id, **message)
         else:
             logger.warning('None recipients, no message will be sent.')
 
@@ -367,7 +392,8 @@ class Moobius:
                         raise Exception('Payload_dict type is neither message_up or message_down.')
                     channel_id = payload_dict['body']['channel_id']
                     payload_dict['body']['recipients'] = await self._update_rec(payload_dict['body']['recipients'], is_mdown, channel_id) # Convert list to group id.
-        await self.ws_client.send(payload_dict)
+        body = payload_dict.get('body')
+        await self._ws_for(body.get('channel_id') if type(body) is dict else None).send(payload_dict)
 
     async def create_channel(self, channel_name, channel_desc, bind=True):
         """Creates a channel given the channel name, the channel description, and whether to bind to the new channel.
@@ -384,20 +410,24 @@ class Moobius:
         if type(canvas_items) is dict or type (canvas_items) is CanvasItem:
             canvas_items = [canvas_items]
         canvas_items = [dataclasses.replace(elem) for elem in canvas_items]
-        for elem in canvas_items:
-            if elem.path:
-                elem.path = await self.http_api.convert_to_url(elem.path)
-        return await self.ws_client.update_canvas(self.client_id, channel_id, canvas_items, await self._update_rec(recipients, True))
+        _, recipients = await asyncio.gather(self._upload_canvas_paths(canvas_items), self._update_rec(recipients, True))
+        return await self._ws_for(channel_id).update_canvas(self.client_id, channel_id, canvas_items, recipients)
+
+    async def _upload_canvas_paths(self, canvas_items):
+        """Replaces the local file paths of a list of CanvasItems with their URLs, uploading them all at once. Modifies the items. Returns None."""
+        items = [elem for elem in canvas_items if elem.path]
+        for elem, url in zip(items, await self.http_api.upload_many([elem.path for elem in items])):
+            elem.path = url
 
     async def send_heartbeat(self):
-        """Sends a heartbeat to the server. Returns None."""
-        await self.ws_client.heartbeat()
+        """Sends a heartbeat to the server on every socket. Returns None."""
+        await self.ws_pool.heartbeat()
 
     async def send_refresh(self, channel_id):
         """Sends a refresh given a channel_id. Returns the message sent. A user function."""
         if self.service_mode:
             logger.warning('Send-refresh is a user function')
-        return await self.ws_client.refresh_as_user(self.client_id, channel_id)
+        return await self._ws_for(channel_id).refresh_as_user(self.client_id, channel_id)
 
     async def do_member_sync(self, channel_id, character):
         """Syncs a member. Accepts a channel_id and character/character_id. Returns None. This is the most common way to send buttons, etc."""
@@ -412,11 +442,49 @@ class Moobius:
         Accepts the channel id. Returns None."""
         pass
 
-    async def send_service_login(self):
-        """Calls self.ws_client.service_login using self.client_id and self.http_api.access_token."""
+    async def _broadcast(self, dry_run_builder, channel_id, recipients_list):
+        """
+        Sends one payload to many recipient lists. Accepts an async function that builds the message (with dry_run=True) given a recipients group id,
+        the channel_id, and a list where each element is a recipients argument (a list of character ids or a group id).
+        The recipient lists are converted to group ids concurrently and the payload is only serialized once.
+        Returns the list of request_ids sent (recipient lists which are empty are skipped).
+        """
+        group_ids = await asyncio.gather(*[self._update_rec(recipients, True) for recipients in recipients_list])
+        group_ids = [group_id for group_id in group_ids if group_id]
+        if not group_ids:
+            return []
+        message = await dry_run_builder(group_ids[0])
+        return await self._ws_for(channel_id).broadcast(message, group_ids)
+
+    async def broadcast_buttons(self, buttons, channel_id, recipients_list):
+        """Like send_buttons but sends the same buttons to each element of recipients_list (a list of recipients). Returns the list of request_ids."""
+        return await self._broadcast(lambda group_id: self._ws_for(channel_id).send_buttons(buttons, self.client_id, channel_id, group_id, dry_run=True), channel_id, recipients_list)
+
+    async def broadcast_menu(self, menu_items, channel_id, recipients_list):
+        """Like send_menu but sends the same menu to each element of recipients_list (a list of recipients). Returns the list of request_ids."""
+        return await self._broadcast(lambda group_id: self._ws_for(channel_id).send_menu(menu_items, self.client_id, channel_id, group_id, dry_run=True), channel_id, recipients_list)
+
+    async def broadcast_style(self, style_items, channel_id, recipients_list):
+        """Like send_style but sends the same style to each element of recipients_list (a list of recipients). Returns the list of request_ids."""
+        return await self._broadcast(lambda group_id: self._ws_for(channel_id).send_style(style_items, self.client_id, channel_id, group_id, dry_run=True), channel_id, recipients_list)
+
+    async def broadcast_canvas(self, canvas_items, channel_id, recipients_list):
+        """Like send_canvas but sends the same canvas to each element of recipients_list (a list of recipients). Images are uploaded once. Returns the list of request_ids."""
+        if type(canvas_items) is dict or type(canvas_items) is CanvasItem:
+            canvas_items = [canvas_items]
+        canvas_items = [dataclasses.replace(elem) for elem in canvas_items]
+        await self._upload_canvas_paths(canvas_items)
+        return await self._broadcast(lambda group_id: self._ws_for(channel_id).update_canvas(self.client_id, channel_id, canvas_items, group_id, dry_run=True), channel_id, recipients_list)
+
+    def _ws_for(self, channel_id):
+        """Returns the WSClient which carries a given channel_id (self.ws_client unless there are several ws_connections)."""
+        return self.ws_pool.for_channel(channel_id)
+
+    async def send_service_login(self, ws_client=None):
+        """Calls service_login using self.client_id and self.http_api.access_token, on a given WSClient (default self.ws_client)."""
         if not self.client_id:
             self.client_id = await self.create_new_service()
-        return await self.ws_client.service_login(self.client_id, self.http_api.access_token)
+        return await (ws_client or self.ws_client).service_login(self.client_id, self.http_api.access_token)
 
     ################################## Single-line functions #######################################
     async def _update_rec(self, recipients, is_m_down, channel_id=None):
@@ -457,17 +525,17 @@ class Moobius:
     async def fetch_user_from_group(self, user_id, channel_id, group_id): """Calls self.http_api.fetch_user_from_group, mainly for internal use."""; return await self.http_api.fetch_user_from_group(user_id, channel_id, group_id)
     async def fetch_target_group(self, user_id, channel_id, group_id): """Calls self.http_api.fetch_target_group, mainly for internal use."""; return await self.http_api.fetch_target_group(user_id, channel_id, group_id)
 
-    async def send_user_login(self): """Calls self.ws_client.user_login using self.http_api.access_token; Use for user mode."""; return await self.ws_client.user_login(self.http_api.access_token)
-    async def send_update(self, data, target_client_id): """Calls self.ws_client.update"""; return await self.ws_client.update(data, self.client_id, target_client_id)
-    async def send_characters(self, characters, channel_id, recipients): """Calls self.ws_client.send_characters using self.client_id. Converts recipients to a group_id if a list."""; return await self.ws_client.send_characters(await self._update_rec(characters, True), self.client_id, channel_id, await self._update_rec(recipients, True))
-    async def send_buttons(self, buttons, channel_id, recipients): """Calls self.ws_client.send_buttons using self.client_id. Converts recipients to a group_id if a list."""; return await self.ws_client.send_buttons(buttons, self.client_id, channel_id, await self._update_rec(recipients, True))
-    async def send_menu(self, menu_items, channel_id, recipients): """Calls self.ws_client.send_menu using self.client_id. Converts recipients to a group_id if a list."""; return await self.ws_client.send_menu(menu_items, self.client_id, channel_id, await self._update_rec(recipients, True))
-    async def send_style(self, style_items, channel_id, recipients): """Calls self.ws_client.send_style using self.client_id. Converts recipients to a group_id if a list."""; return await self.ws_client.send_style(style_items, self.client_id, channel_id, await self._update_rec(recipients, True))
+    async def send_user_login(self, ws_client=None): """Calls user_login on a given WSClient (default self.ws_client) using self.http_api.access_token; Use for user mode."""; return await (ws_client or self.ws_client).user_login(self.http_api.access_token)
+    async def send_update(self, data, target_client_id): """Calls self.ws_client.update (on the socket for data["channel_id"], if given)"""; return await self._ws_for(data.get('channel_id') if type(data) is dict else None).update(data, self.client_id, target_client_id)
+    async def send_characters(self, characters, channel_id, recipients): """Calls self.ws_client.send_characters using self.client_id. Converts recipients to a group_id if a list."""; return await self._ws_for(channel_id).send_characters(await self._update_rec(characters, True), self.client_id, channel_id, await self._update_rec(recipients, True))
+    async def send_buttons(self, buttons, channel_id, recipients): """Calls self.ws_client.send_buttons using self.client_id. Converts recipients to a group_id if a list."""; return await self._ws_for(channel_id).send_buttons(buttons, self.client_id, channel_id, await self._update_rec(recipients, True))
+    async def send_menu(self, menu_items, channel_id, recipients): """Calls self.ws_client.send_menu using self.client_id. Converts recipients to a group_id if a list."""; return await self._ws_for(channel_id).send_menu(menu_items, self.client_id, channel_id, await self._update_rec(recipients, True))
+    async def send_style(self, style_items, channel_id, recipients): """Calls self.ws_client.send_style using self.client_id. Converts recipients to a group_id if a list."""; return await self._ws_for(channel_id).send_style(style_items, self.client_id, channel_id, await self._update_rec(recipients, True))
 
-    async def send_join_channel(self, channel_id): """Calls self.ws_client.join_channel using self.client_id. Use for user mode."""; return await self.ws_client.join_channel(self.client_id, channel_id)
-    async def send_leave_channel(self, channel_id): """Calls self.ws_client.leave_channel using self.client_id. Used for user mode."""; return await self.ws_client.leave_channel(self.client_id, channel_id)
-    async def send_button_click(self, button_id, bottom_button_id, button_args, channel_id): """Calls self.ws_client.send_button_click using self.client_id. Used for user mode."""; await self.ws_client.send_button_click(button_id, bottom_button_id, button_args, channel_id, self.client_id, dry_run=False)
-    async def send_menu_item_click(self, menu_item_id, bottom_button_id, button_args, the_message, channel_id): """Calls self.ws_client.send_menu_item_click using self.client_id. Used for user mode."""; await self.ws_client.send_menu_item_click(menu_item_id, bottom_button_id, button_args, the_message, channel_id, self.client_id, dry_run=False)
+    async def send_join_channel(self, channel_id): """Calls self.ws_client.join_channel using self.client_id. Use for user mode."""; return await self._ws_for(channel_id).join_channel(self.client_id, channel_id)
+    async def send_leave_channel(self, channel_id): """Calls self.ws_client.leave_channel using self.client_id. Used for user mode."""; return await self._ws_for(channel_id).leave_channel(self.client_id, channel_id)
+    async def send_button_click(self, button_id, bottom_button_id, button_args, channel_id): """Calls self.ws_client.send_button_click using self.client_id. Used for user mode."""; await self._ws_for(channel_id).send_button_click(button_id, bottom_button_id, button_args, channel_id, self.client_id, dry_run=False)
+    async def send_menu_item_click(self, menu_item_id, bottom_button_id, button_args, the_message, channel_id): """Calls self.ws_client.send_menu_item_click using self.client_id. Used for user mode."""; await self._ws_for(channel_id).send_menu_item_click(menu_item_id, bottom_button_id, button_args, the_message, channel_id, self.client_id, dry_run=False)
 
     ################################## Callback switchyards #######################################
 
@@ -485,9 +553,10 @@ class Moobius:
             await self.on_spell(obj)
 
     @logger.catch
-    async def handle_received_payload(self, payload):
+    async def handle_received_payload(self, payload, ws_client=None):
         """
-        Decodes the received websocket payload JSON and calls the handler based on p['type'], given the payload string. Returns None.
+        Decodes the received websocket payload JSON and calls the handler based on p['type'], given the payload string or the already decoded dict,
+        and optionally the WSClient it arrived on (default self.ws_client). Returns None.
         Example methods called:
           on_message_up(), on_action(), on_button_click(), on_copy_client(), on_unknown_payload()
 
@@ -495,7 +564,8 @@ class Moobius:
           >>> self.ws_client = WSClient(ws_server_uri, on_connect=self.send_service_login, handle=self.handle_received_payload)
         """
 
-        payload_data = json.loads(payload)
+        ws_client = ws_client or self.ws_client
+        payload_data = payload if type(payload) is dict else ws_client.codec.loads(payload)
         if 'message' in payload_data:
             if payload_data['message'].lower().strip() == 'Internal server error'.lower():
                 logger.error('Received an internal server error from the Websocket.')
@@ -517,6 +587,7 @@ class Moobius:
 
         if 'type' in payload_data:
             payload = from_dict(data_class=Payload, data=payload_data) # Brittle type inference.
+            self._invalidate_http_cache(payload.type, payload_body)
             if payload.type == types.MESSAGE_DOWN:
                 payload_body = types.recv_tmp_convert('on_message_down', payload_body)
                 payload_body['content'] = MessageContent(**payload_body['content'])
@@ -540,7 +611,7 @@ class Moobius:
             elif payload.type == types.ACTION:
                 await self.on_action(payload_body)
             elif payload.type == types.COPY:
-                await self.on_copy_client(CopyBody(**payload_body))
+                await self.on_copy_client(CopyBody(**payload_body), ws_client=ws_client)
             elif payload.type == types.REFRESH:
                 payload_body['subtype'] = types.REFRESH
                 await self.on_refresh(SimpleAction(**payload_body))
@@ -550,6 +621,18 @@ class Moobius:
         else:
             logger.error(f"Unknown payload without type: {payload_data}")
 
+    def _invalidate_http_cache(self, payload_type, payload_body):
+        """Drops the cached HTTP responses that a join, leave or update payload makes stale, so the callbacks see fresh data. Returns None."""
+        channel_id = payload_body.get('channel_id')
+        subtype = payload_body.get('subtype')
+        if payload_type == types.ACTION and subtype in [types.JOIN, types.LEAVE_CHANNEL] and channel_id:
+            self.http_api.invalidate_cache('/channel/character_list', '/user/group', channel_id=channel_id)
+        elif payload_type == types.UPDATE and subtype == types.UPDATE_CHARACTERS and channel_id:
+            self.http_api.invalidate_cache('/channel/character_list', '/user/group', channel_id=channel_id)
+            self.http_api.invalidate_cache('/character/fetch_profile')
+        elif payload_type == types.UPDATE and subtype == types.UPDATE_CHANNEL_INFO:
+            self.http_api.invalidate_cache('/channel/list')
+
     async def on_action(self, action_data: dict):
         """
         Accepts the action data (as a dict) from a user. Returns None.
@@ -627,13 +710,14 @@ class Moobius:
         """
         logger.debug(f"MessageUp received: {message}")
 
-    async def on_copy_client(self, copy: CopyBody):
+    async def on_copy_client(self, copy: CopyBody, ws_client=None):
         """
-        This callback accepts a "Copy" request from the user. Returns None.
+        This callback accepts a "Copy" request from the user, and the WSClient it arrived on (default self.ws_client). Returns None.
+        A failed copy in service mode logs that socket in again.
         Example Copy object:
         >>> moobius.Copy(request_id=<id>, origin_type=message_down, status=True, context={'message': 'Message received'})"""
         if self.service_mode and not copy.status:
-            await self.send_service_login()
+            await self.send_service_login(ws_client)
         logger.debug("on_copy_client")
 
     async def on_refresh(self, action: SimpleAction):
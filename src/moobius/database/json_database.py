@@ -57,7 +57,9 @@ class JSONDatabase(DatabaseInterface):
         """Updates and saves a cached dict, given a string-valued key and a dict-valued value. Returns (is_success, the key).
            Note: This function should not be called directly."""
         filename = os.path.join(self.path, key + '.json')
-        json_utils.enhanced_json_save(filename, value)
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        json_utils.enhanced_json_save(tmp_filename, value)
+        os.replace(tmp_filename, filename) # Atomic, so another process never reads a half-written file.
         return True, key
 
     def delete_key(self, key):
@@ -96,6 +96,104 @@ def enhanced_json_save(filename, data, typemark_dataclasses=True, indent=2):
     return txt
 
 
+def _dataclass_default(obj):
+    """The "default" hook for json.dumps: dataclasses become shallow dicts (nested values are handled by json itself), sets become lists.
+    Accepts the object that json cannot serialize. Returns a serializable version. Raises a TypeError for anything else."""
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)}
+    if type(obj) in [set, frozenset]:
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class JSONCodec:
+    """The standard library codec. Always available. Dataclasses are serialized on the fly without making a deep dict copy first."""
+    name = 'json'
+
+    def dumps(self, data):
+        """Accepts a datastructure which may contain dataclasses. Returns a JSON string."""
+        return json.dumps(data, default=_dataclass_default)
+
+    def loads(self, txt):
+        """Accepts a JSON string or bytes. Returns the datastructure."""
+        return json.loads(txt)
+
+    def __str__(self):
+        return f'moobius.{type(self).__name__}()'
+    def __repr__(self):
+        return self.__str__()
+
+
+class OrjsonCodec(JSONCodec):
+    """Uses the orjson package (pip install orjson), which serializes dataclasses natively and is several times faster than the standard library."""
+    name = 'orjson'
+
+    def __init__(self):
+        """Imports orjson, raising an ImportError if it is not installed."""
+        import orjson
+        self._orjson = orjson
+        self._option = orjson.OPT_NON_STR_KEYS # Match json.dumps, which converts int keys to strings.
+
+    def dumps(self, data):
+        """Accepts a datastructure which may contain dataclasses. Returns a JSON string."""
+        return self._orjson.dumps(data, default=_dataclass_default, option=self._option).decode('utf-8')
+
+    def loads(self, txt):
+        """Accepts a JSON string or bytes. Returns the datastructure."""
+        return self._orjson.loads(txt)
+
+
+class MsgspecCodec(JSONCodec):
+    """Uses the msgspec package (pip install msgspec), which serializes dataclasses natively and is several times faster than the standard library."""
+    name = 'msgspec'
+
+    def __init__(self):
+        """Imports msgspec, raising an ImportError if it is not installed."""
+        import msgspec
+        self._encoder = msgspec.json.Encoder(enc_hook=_dataclass_default)
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, data):
+        """Accepts a datastructure which may contain dataclasses. Returns a JSON string."""
+        return self._encoder.encode(data).decode('utf-8')
+
+    def loads(self, txt):
+        """Accepts a JSON string or bytes. Returns the datastructure."""
+        return self._decoder.decode(txt)
+
+
+def get_codec(implementation='auto'):
+    """
+    Given an implementation string, returns a codec object with dumps() and loads() methods. Used for the websocket and HTTP payloads.
+    Last-minute-imports the optional package so that no pip package is needed for unused codecs.
+
+    Parameters:
+      implementation='auto': "orjson", "msgspec", "json" (the standard library), or "auto" which picks the first one installed in that order.
+        A codec object is returned unchanged.
+
+    Returns the codec.
+
+    Raises:
+      An Exception if the implementation is unknown, or an ImportError if the requested package is not installed.
+    """
+    if implementation is None:
+        implementation = 'auto'
+    if not isinstance(implementation, str):
+        return implementation
+    implementation = implementation.lower().strip()
+    name2class = {'orjson':OrjsonCodec, 'msgspec':MsgspecCodec, 'json':JSONCodec, 'stdlib':JSONCodec}
+    if implementation == 'auto':
+        for codec_class in [OrjsonCodec, MsgspecCodec]:
+            try:
+                return codec_class()
+            except ImportError:
+                pass
+        return JSONCodec()
+    if implementation not in name2class:
+        raise Exception(f'Unknown JSON codec {implementation}, must be one of {list(name2class.keys())+["auto"]}.')
+    return name2class[implementation]()
+
+
 def recursive_json_load(x):
     """
     Loads json files into dicts and lists, including dicts/lists of json filenames. Used for the app configuration.
@@ -0,0 +1,107 @@
+# Tracks which sent socket messages the server has acknowledged.
+# Every message the WSClient builds carries a fresh request_id, and the server answers with a "copy" (or "roger") payload whose body repeats that request_id.
+# The body's "status" says whether the server accepted the message; a False status is a rejection, not a delivery.
+# This module is designed to be used by the WSClient.
+
+import asyncio, time
+from collections import deque
+
+from moobius import types
+
+
+def ack_request_id(payload):
+    """Given a decoded inbound payload, returns the request_id it acknowledges, or None if it is not an acknowledgement."""
+    if type(payload) is not dict or payload.get('type') not in (types.COPY, types.ROGER):
+        return None
+    body = payload.get('body')
+    if type(body) is not dict:
+        return None
+    return body.get('request_id')
+
+
+def ack_accepted(payload):
+    """Given an acknowledgement payload (see ack_request_id), returns False if its body has a False "status" (the server rejected the request), otherwise True."""
+    return bool(payload['body'].get('status', True))
+
+
+class AckRejectedException(Exception):
+    """Raised to whoever waits on a request when the server acknowledges it with a False status. Holds the acknowledgement body."""
+    def __init__(self, request_id, body):
+        super().__init__(f'The server rejected request {request_id}: {body}')
+        self.request_id = request_id
+        self.body = body
+
+
+class AckTracker:
+    """
+    (This class is for internal use).
+    A table from request_id to a future that is resolved with the "copy" body when the server accepts that request,
+    or fails with an AckRejectedException when the server rejects it.
+    Also keeps round-trip statistics (from when the message was handed to send() until the acknowledgement arrived).
+    Every acknowledgement, awaited or not, is also passed to on_ack, which the WSClient uses to release journaled messages once the server accepts them.
+    """
+
+    def __init__(self, max_samples=1024, on_ack=None):
+        """Creates an empty table. max_samples is how many recent round-trip times are kept for the percentiles in stats().
+        on_ack is an optional function called with the request_id of every acknowledgement and whether it was accepted, which returns True if it was expecting it."""
+        self.on_ack = on_ack
+        self.pending = {} # request_id => [future, time it was first sent].
+        self.rtt_samples = deque(maxlen=max_samples)
+        self.counters = {'tracked':0, 'acked':0, 'rejected':0, 'retries':0, 'timeouts':0, 'unmatched':0}
+
+    def expect(self, request_id):
+        """Starts tracking a request_id. Returns the future that resolve() will complete. Tracking the same request_id twice returns the same future."""
+        entry = self.pending.get(request_id)
+        if entry is None:
+            entry = [asyncio.get_running_loop().create_future(), time.perf_counter()]
+            self.pending[request_id] = entry
+            self.counters['tracked'] += 1
+        return entry[0]
+
+    def resolve(self, payload):
+        """
+        Given a decoded inbound payload, completes the matching future if it is an acknowledgement of a tracked request:
+        with the body if the server accepted it, or with an AckRejectedException if not.
+        Returns True if a tracked request was acknowledged (accepted or rejected).
+        """
+        request_id = ack_request_id(payload)
+        if request_id is None:
+            return False
+        accepted = ack_accepted(payload)
+        expected = self.on_ack(request_id, accepted) if self.on_ack is not None else False
+        entry = self.pending.pop(request_id, None)
+        if entry is None:
+            if not expected:
+                self.counters['unmatched'] += 1 # Not waited on, or it already timed out.
+            return False
+        future, t0 = entry
+        self.rtt_samples.append(time.perf_counter() - t0)
+        if future.done():
+            return True
+        if accepted:
+            self.counters['acked'] += 1
+            future.set_result(payload['body'])
+        else:
+            self.counters['rejected'] += 1
+            future.set_exception(AckRejectedException(request_id, payload['body']))
+        return True
+
+    def discard(self, request_id):
+        """Stops tracking a request_id, such as after the last retry times out. Returns None."""
+        entry = self.pending.pop(request_id, None)
+        if entry is not None and not entry[0].done():
+            entry[0].cancel()
+
+    def stats(self):
+        """Returns a dict with the counters, how many requests are awaiting acknowledgement, and round-trip times in seconds (last, mean, p50, p99, max) over the recent samples."""
+        out = {'awaiting': len(self.pending), **self.counters}
+        if self.rtt_samples:
+            samples = sorted(self.rtt_samples)
+            out['rtt'] = {'last': self.rtt_samples[-1], 'mean': sum(samples)/len(samples),
+                          'p50': samples[len(samples)//2], 'p99': samples[min(len(samples)-1, int(len(samples)*0.99))], 'max': samples[-1]}
+        return out
+
+    def __str__(self):
+        return f'moobius.AckTracker(awaiting={len(self.pending)}, acked={self.counters["acked"]})'
+    def __repr__(self):
+        return self.__str__()
@@ -1,14 +1,23 @@
 # aiohttp-based wrapper for HTTPS interaction with the platform.
 # Handles auth as well as GET and POST requests.
 # This module is designed to be used by the Moobius service.
-import json, os, io, hashlib, datetime, random, re
+import asyncio, contextlib, copy, json, os, hashlib, datetime, random, re
 import aiohttp
 from loguru import logger
 from dacite import from_dict
-from moobius import types
+from moobius import types, json_utils
 from moobius.types import Character, Group, UserInfo, MessageBody
+from moobius.network.http_cache import ResponseCache, path_of
+from moobius.network.http_rate_limit import HTTPRateLimiter
+from moobius.network.ranged_download import RangedDownload
+from moobius.network.upload_cache import UploadCache
+from moobius.network.http_policies import RetryPolicy, CircuitBreakers, CircuitOpenException, TransientHTTPError, endpoint_of, parse_retry_after
 # TODO: refresh
 _URL2example_response = {} # Debug tool that allows inspecting example responses.
+# Paths (relative to the http_server_uri, without the query string) of GETs which only read, so identical ones in flight at once can share a response.
+# GETs that hand out something new each time (such as an upload slot from /file/upload) must never be listed here.
+SINGLE_FLIGHT_GETS = frozenset(['/channel/character_list', '/channel/history_message', '/channel/list', '/channel/popular', '/service/character/list',
+                                '/service/group', '/service/list', '/user/group', '/user/group/list', '/user/group/temp', '/user/info'])
 
 
 def summarize_html(html_str):
@@ -29,7 +38,7 @@ def summarize_html(html_str):
     return html_str.strip()
 
 
-async def get_or_post(url, is_post, requests_kwargs=None, raise_json_decode_errors=True):
+async def get_or_post(url, is_post, requests_kwargs=None, raise_json_decode_errors=True, codec=None, session=None, retry_statuses=()):
     """
     Sends a GET or POST request and awaits for the response.
 
@@ -38,6 +47,9 @@ async def get_or_post(url, is_post, requests_kwargs=None, raise_json_decode_erro
       is_post (bool): False for GET, True for POST.
       requests_kwargs=None: These are fed into the requests/session get/post function.
       raise_json_decode_errors=True: Raise errors parsing the JSON that the request sends back, otherwise return the error as a dict.
+      codec=None: The json_utils codec used to encode the "json" kwarg and decode the response. None uses the standard library.
+      session=None: The aiohttp.ClientSession to send it on, so that its pooled connections are reused. None opens (and closes) a session just for this request.
+      retry_statuses=(): HTTP statuses that raise a TransientHTTPError instead of being read, so that the caller can retry.
 
     Returns: A dict which is the json.loads() of the return.
       Error condition if JSON decoding fails:
@@ -49,29 +61,57 @@ async def get_or_post(url, is_post, requests_kwargs=None, raise_json_decode_erro
 
     Raises:
       An Exception if Json fails and raise_json is True. Not all non-error returns are JSON thus the "blob" option.
+      A TransientHTTPError if the status is one of the retry_statuses.
     """
-    async with aiohttp.ClientSession() as session:
-        async with (session.post if is_post else session.get)(url, **requests_kwargs) as resp:
-            try:
-                response_dict = await resp.json()
-                return response_dict
-            except aiohttp.client_exceptions.ContentTypeError:
-                response_txt = await resp.text()
-                if raise_json_decode_errors:
-                    if not response_txt.strip():
-                        raise Exception(f'Empty string.')
-                    if len(response_txt)<384:
-                        raise Exception(f'JSON cannot decode: {response_txt}')
-                    elif '<div' in response_txt or 'div>' in response_txt: # HTML when it should be JSON.
-                        summary_txt = summarize_html(response_txt)
-                        raise Exception(f'JSON cannot decode long HTML stuff, here is a summary: {summary_txt}')
-                    else:
-                        raise Exception(f'JSON cannot decode long string: {response_txt[0:384]}...')
+    codec = codec or json_utils.get_codec('json')
+    if session is None:
+        async with aiohttp.ClientSession(json_serialize=codec.dumps) as session:
+            return await get_or_post(url, is_post, requests_kwargs, raise_json_decode_errors, codec, session, retry_statuses)
+    async with (session.post if is_post else session.get)(url, **requests_kwargs) as resp:
+        if resp.status in retry_statuses:
+            raise TransientHTTPError(resp.status, parse_retry_after(resp.headers.get('Retry-After')), url)
+        try:
+            response_dict = await resp.json(loads=codec.loads)
+            return response_dict
+        except aiohttp.client_exceptions.ContentTypeError:
+            response_txt = await resp.text()
+            if raise_json_decode_errors:
+                if not response_txt.strip():
+                    raise Exception(f'Empty string.')
+                if len(response_txt)<384:
+                    raise Exception(f'JSON cannot decode: {response_txt}')
+                elif '<div' in response_txt or 'div>' in response_txt: # HTML when it should be JSON.
+                    summary_txt = summarize_html(response_txt)
+                    raise Exception(f'JSON cannot decode long HTML stuff, here is a summary: {summary_txt}')
                 else:
-                    status_code = resp.status
-                    if status_code is None:
-                        raise Exception('Status code should be an int (after awaiting) but is None.')
-                    return {'blob': str(response_txt), 'code':status_code}
+                    raise Exception(f'JSON cannot decode long string: {response_txt[0:384]}...')
+            else:
+                status_code = resp.status
+                if status_code is None:
+                    raise Exception('Status code should be an int (after awaiting) but is None.')
+                return {'blob': str(response_txt), 'code':status_code}
+
+
+def file_sha256(file_path, chunk_size=1<<20):
+    """Returns the hex SHA-256 of a file, reading it chunk_size bytes at a time so that memory use does not grow with the file size."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _source_url(source):
+    """Given a url or a MessageBody with a .content.path, returns the url to download."""
+    if type(source) is str:
+        return source
+    elif type(source) is MessageBody:
+        if hasattr(source.content, 'path') and source.content.path:
+            return source.content.path
+        else:
+            raise Exception("This message does not have a path in it's content.")
+    else:
+        raise Exception(f"Source must be a str or MessageBody, not a {type(source)}")
 
 
 class BadResponseException(Exception):
@@ -93,14 +133,48 @@ class HTTPAPIWrapper:
       File: Upload files (automatically fetches the URL needed).
       Group: Combine users, services, or channels into groups which can be addressed by a single group_id.
     """
-    def __init__(self, http_server_uri="", email="", password=""):
+    def __init__(self, http_server_uri="", email="", password="", json_codec="auto",
+                 connection_limit=100, connection_limit_per_host=0, keepalive_timeout=30.0, dns_cache_ttl=300,
+                 retry_attempts=3, retry_base_delay=0.25, retry_max_delay=8.0, circuit_breaker=True, circuit_failure_threshold=5, circuit_reset_timeout=30.0,
+                 rate_limits=None, single_flight_gets=True, response_cache=False, response_cache_size=1024,
+                 download_chunk_size=1<<20, download_attempts=4, download_parallel=1, download_parallel_min_size=16<<20,
+                 upload_cache=None, upload_concurrency=16):
         """
         Initializes the HTTP API wrapper.
+        All requests share one aiohttp session, so connections (and their TLS handshakes and DNS lookups) are reused.
+        The session is opened by start() and closed by close(). It is opened on first use if start() was not called.
 
         Parameters:
           http_server_uri (str): The URI of the Moobius HTTP server.
           email (str): The email of the user.
           password (str): The password of the user.
+          json_codec="auto": The JSON codec for request and response bodies, see json_utils.get_codec.
+          connection_limit=100: The most connections open at once, over all hosts. 0 means no limit.
+          connection_limit_per_host=0: The most connections open at once to a single host. 0 (the default, as in aiohttp) means no limit.
+          keepalive_timeout=30.0: Seconds an idle connection is kept open for reuse.
+          dns_cache_ttl=300: Seconds a DNS lookup is cached. None caches forever.
+          retry_attempts=3: Attempts per request for transient failures (5xx, 429, dropped connections, timeouts). 1 turns retrying off.
+            GETs and the POSTs in http_policies.IDEMPOTENT_POSTS are retried; other POSTs only if the connection could not be made at all.
+          retry_base_delay=0.25: Seconds before the first retry, doubled for each one after, with jitter. A Retry-After header takes precedence.
+          retry_max_delay=8.0: The longest backoff between attempts.
+          circuit_breaker=True: Fail fast with a CircuitOpenException for an endpoint that keeps failing, rather than sending more requests to it.
+          circuit_failure_threshold=5: Failed requests in a row (after their retries) that open an endpoint's circuit.
+          circuit_reset_timeout=30.0: Seconds an open circuit fails fast before letting a trial request through.
+          rate_limits=None: Client-side token buckets and concurrency caps per endpoint family. None (or False) does not limit requests.
+            True uses the preset in http_rate_limit.DEFAULT_RATE_LIMITS; a dict is merged over that preset (for example {"group": {"rate": 20, "burst": 40, "max_concurrency": 8}}).
+          single_flight_gets=True: Identical read-only GETs (same url, params and headers; the paths in SINGLE_FLIGHT_GETS) that overlap in time share one request,
+            and each caller gets its own copy of the response. Other GETs are always sent on their own.
+          response_cache=False: Cache the responses of queries that rarely change (profiles, agent lists, channel lists, group members) for a while.
+            True uses the time-to-live per path in http_cache.DEFAULT_CACHE_TTLS; a dict of path => seconds is merged over those. See invalidate_cache().
+          response_cache_size=1024: The most responses cached; the least recently used are dropped first.
+          download_chunk_size=1<<20: Bytes read from the socket at a time when downloading to a file or with iter_download().
+          download_attempts=4: Attempts per file download; each one continues where the dropped connection left off.
+          download_parallel=1: How many ranges of a large file download() fetches at once.
+          download_parallel_min_size=16<<20: Files smaller than this many bytes are always downloaded as one stream.
+          upload_cache=None: Persist which files were uploaded where, so a restarted service does not upload them again.
+            A dict like a db_config entry, {"implementation": "json", "settings": {"root_dir": "json_db"}}, optionally with a "domain" name.
+            Processes using the same store share it. None only remembers uploads in memory.
+          upload_concurrency=16: The most files upload_many() hashes or uploads at the same time.
 
         Example:
           >>> http_api_wrapper = HTTPAPIWrapper("http://localhost:8080", "test@test", "test")
@@ -111,6 +185,69 @@ class HTTPAPIWrapper:
         self.access_token = ""
         self.refresh_token = ""
         self.filehash2URL = {} # Avoid uploading the same file twice!
+        self.codec = json_utils.get_codec(json_codec)
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session = None
+        self._session_loop = None
+        self.retry_policy = RetryPolicy(max_attempts=retry_attempts, base_delay=retry_base_delay, max_delay=retry_max_delay)
+        self.circuit_breakers = CircuitBreakers(failure_threshold=circuit_failure_threshold, reset_timeout=circuit_reset_timeout, enabled=circuit_breaker)
+        self.rate_limiter = None
+        if rate_limits:
+            self.rate_limiter = HTTPRateLimiter(http_server_uri, rate_limits if type(rate_limits) is dict else None)
+        self.single_flight_gets = single_flight_gets
+        self.download_chunk_size = download_chunk_size
+        self.download_attempts = download_attempts
+        self.download_parallel = download_parallel
+        self.download_parallel_min_size = download_parallel_min_size
+        self.upload_cache = UploadCache(**upload_cache) if upload_cache else None
+        self.upload_concurrency = upload_concurrency
+        self._uploading = {} # SHA-256 => Task of the upload in progress.
+        self.response_cache = None
+        if response_cache:
+            self.response_cache = ResponseCache(http_server_uri, response_cache if type(response_cache) is dict else None, response_cache_size)
+        self._inflight_gets = {} # Request key => [Task, number of callers waiting on it].
+        self.http_counters = {'requests':0, 'retries':0, 'failures':0, 'fast_failed':0, 'circuits_opened':0, 'deduplicated':0}
+
+    async def start(self):
+        """Opens the pooled aiohttp session, if it is not already open. Called by Moobius.start(). Returns None."""
+        await self.session()
+
+    async def close(self):
+        """Closes the pooled aiohttp session and its connections. Requests after this open a new one. Returns None."""
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    @staticmethod
+    async def _close_stale_session(session, old_loop):
+        """Closes a session opened in a different event loop. Never raises. Returns None.
+        If that loop is still running (in another thread) the session is closed there, otherwise it is closed from this loop
+        (its connections are closed at once; anything left waiting on the stopped loop is abandoned)."""
+        try:
+            if old_loop is not None and old_loop.is_running():
+                asyncio.run_coroutine_threadsafe(session.close(), old_loop)
+            else:
+                await session.close()
+        except Exception as e:
+            logger.warning(f'Could not close an HTTP session left over from another event loop: {e}')
+
+    async def session(self):
+        """
+        Returns the shared aiohttp.ClientSession, opening it if need be.
+        A session belongs to the event loop it was opened in, so a session left over from a different loop is closed and a new one opened.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            if self._session is not None and not self._session.closed:
+                await self._close_stale_session(self._session, self._session_loop)
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, limit_per_host=self.connection_limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=self.dns_cache_ttl)
+            self._session = aiohttp.ClientSession(connector=connector, json_serialize=self.codec.dumps)
+            self._session_loop = loop
+        return self._session
 
     async def _checked_get_or_post(self, url, the_request, is_post, requests_kwargs=None, good_message=None, bad_message="This HTTPs request failed", raise_errors=True):
         """
@@ -121,6 +258,7 @@ class HTTPAPIWrapper:
              the_request (dict): The "json" kwarg is set to this. Can be None in which no "json" will be set.
              is_post: True for post, False for get.
              requests_kwargs=None: Dict of extra arguments to send to requests/aiohttp. None is equivalent to {}
+               A callable "data" is called once per attempt to make the body, for bodies that can only be sent once.
              good_message=None: The string-valued message to logger.debug. None means do not log.
              bad_message="...": The string-valued message to prepend to logger.error if the response isnt code 10000.
              raise_errors=True: Raise a BadResponseException if the request returns an error.
@@ -130,6 +268,7 @@ class HTTPAPIWrapper:
 
            Raises:
              BadResponseException if raise_errors=True and the response is an error response.
+             CircuitOpenException if the endpoint has been failing and its circuit breaker is open.
         """
         if the_request is not None and type(the_request) is not dict:
             raise Exception(f'the_request must be None or a dict, not a {type(the_request)} because; dicts are turned into json.')
@@ -137,6 +276,11 @@ class HTTPAPIWrapper:
             requests_kwargs = {}
         if the_request is not None:
             requests_kwargs['json'] = the_request
+        cache_key, cache_ttl = self.response_cache.key_for(url, is_post, requests_kwargs) if self.response_cache else (None, None)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
         kwarg_str = [] # Logging.
         for k in sorted(list(requests_kwargs.keys())):
             v = str(requests_kwargs[k])
@@ -156,10 +300,17 @@ class HTTPAPIWrapper:
         req_info_str = f"{'POST' if is_post else 'GET'} URL={url} {kwarg_str.replace('<', '&lt;').replace('>', '&gt;')}"
         logger.opt(colors=True).info(f"<fg 160,0,240>{req_info_str}</>")
 
-        response_dict = await get_or_post(url, is_post, requests_kwargs=requests_kwargs, raise_json_decode_errors=raise_errors)
+        if is_post or not self.single_flight_gets or path_of(self.http_server_uri, url) not in SINGLE_FLIGHT_GETS:
+            response_dict = await self._send_with_policies(url, is_post, requests_kwargs, raise_errors)
+        else:
+            response_dict = await self._single_flight_get(url, requests_kwargs, raise_errors)
         if response_dict.get('code') in [204, 10000]:
             if good_message is not None:
                 logger.debug(good_message)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, cache_ttl, response_dict)
+            elif is_post and self.response_cache:
+                self.response_cache.note_write(url)
         else:
             error_code = response_dict.get('code')
             err_message = f"{bad_message+': ' if bad_message else ''}'code='{error_code} 'message='{response_dict.get('message')}"
@@ -174,6 +325,95 @@ class HTTPAPIWrapper:
         _URL2example_response[url] = response_dict # Debug.
         return response_dict
 
+    async def _send_with_policies(self, url, is_post, requests_kwargs, raise_json_decode_errors):
+        """
+        Sends a request with get_or_post, retrying transient failures as the retry policy allows and going through the endpoint's circuit breaker.
+        Each attempt waits for the rate limiter first.
+        The last attempt reads a retryable status like any other response, so running out of retries behaves like a request that was never retried.
+        Returns the response dict. Raises a CircuitOpenException, or whatever the last attempt raised.
+        """
+        breaker = self.circuit_breakers.get(endpoint_of(url, is_post)) if self.circuit_breakers.enabled else None
+        if breaker is not None and not breaker.allow():
+            self.http_counters['fast_failed'] += 1
+            raise CircuitOpenException(f'{breaker.endpoint} has failed {breaker.failures} times in a row, failing fast for {breaker.retry_in():.1f}s more.')
+        policy = self.retry_policy
+        idempotent = policy.is_idempotent(url, is_post)
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                self.http_counters['requests'] += 1
+                retry_statuses = policy.retry_statuses if idempotent and attempt < policy.max_attempts else () # Otherwise the response is read as usual.
+                attempt_kwargs = requests_kwargs
+                if callable(requests_kwargs.get('data')): # A factory for data that can only be sent once, such as a streamed multipart form.
+                    attempt_kwargs = {**requests_kwargs, 'data': requests_kwargs['data']()}
+                try:
+                    async with (self.rate_limiter.slot(url) if self.rate_limiter else contextlib.nullcontext()):
+                        response_dict = await get_or_post(url, is_post, requests_kwargs=attempt_kwargs, raise_json_decode_errors=raise_json_decode_errors,
+                                                          codec=self.codec, session=await self.session(), retry_statuses=retry_statuses)
+                except Exception as e:
+                    delay = policy.delay(attempt, e) if policy.should_retry(url, is_post, attempt, e) else None
+                    if delay is None:
+                        raise
+                    self.http_counters['retries'] += 1
+                    logger.warning(f"{'POST' if is_post else 'GET'} {url} failed ({type(e).__name__}: {e}), retry {attempt}/{policy.max_attempts-1} in {delay:.2f}s.")
+                    await asyncio.sleep(delay)
+                    continue
+                break
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.abandon()
+            raise
+        except Exception as e:
+            self.http_counters['failures'] += 1
+            if breaker is not None: # Any failure to get a readable response counts, not only the retryable ones.
+                self._record_failure(breaker)
+            raise
+        if breaker is not None:
+            if response_dict.get('code') in policy.retry_statuses: # A retryable status that was read on the last attempt (no raise_errors).
+                self._record_failure(breaker)
+            else:
+                breaker.record_success()
+        return response_dict
+
+    async def _single_flight_get(self, url, requests_kwargs, raise_json_decode_errors):
+        """
+        Sends a GET with _send_with_policies, unless an identical GET is already in flight, in which case it waits for that one instead.
+        Only for GETs that do not change anything (see SINGLE_FLIGHT_GETS).
+        Returns the response dict; a copy of it if other callers shared it, so that nobody sees another caller's changes. Raises what the request raised.
+        """
+        key = (url, raise_json_decode_errors, json.dumps(requests_kwargs, sort_keys=True, default=str))
+        entry = self._inflight_gets.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self._send_with_policies(url, False, requests_kwargs, raise_json_decode_errors))
+            entry = [task, 0]
+            self._inflight_gets[key] = entry
+            task.add_done_callback(lambda _: self._inflight_gets.pop(key, None) if self._inflight_gets.get(key) is entry else None)
+        else:
+            self.http_counters['deduplicated'] += 1
+        entry[1] += 1
+        response_dict = await asyncio.shield(entry[0]) # One caller being cancelled does not cancel the request for the others.
+        return copy.deepcopy(response_dict) if entry[1] > 1 else response_dict
+
+    def _record_failure(self, breaker):
+        """Counts a failure on a circuit breaker and logs if that opened it. Returns None."""
+        if breaker.record_failure():
+            self.http_counters['circuits_opened'] += 1
+            logger.error(f'Opening the circuit breaker for {breaker.endpoint} after {breaker.failures} failures in a row, failing fast for {breaker.reset_timeout}s.')
+
+    def invalidate_cache(self, *paths, channel_id=None):
+        """
+        Drops cached responses so that the next call fetches them again. Does nothing if the response cache is off.
+        Accepts the paths to drop (such as "/channel/character_list", none given means all) and an optional channel_id to only drop the requests about that channel.
+        Returns how many responses were dropped.
+        """
+        return self.response_cache.invalidate(*paths, channel_id=channel_id) if self.response_cache else 0
+
+    def http_stats(self):
+        """Returns a dict with the request/retry/failure counters, the state of every circuit breaker that has seen failures, the rate limiter's wait times per family, and the response cache stats."""
+        return {**self.http_counters, 'circuits': self.circuit_breakers.stats(), 'rate_limits': self.rate_limiter.stats() if self.rate_limiter else {},
+                'cache': self.response_cache.stats() if self.response_cache else {}}
+
     async def checked_get(self, url, the_request, requests_kwargs=None, good_message=None, bad_message="This HTTPs GET request failed", raise_errors=True):
         """
         Calls self._checked_get_or_post with is_post=False.
@@ -551,6 +791,7 @@ class HTTPAPIWrapper:
     async def _do_upload(self, upload_url, upload_fields, file_path):
         """
         Uploads a file to the given upload URL with the given upload fields.
+        The file is streamed from disk as the last part of a multipart form, so it is never held in memory.
 
         Parameters:
           upload_url (str): obtained with _upload_extension.
@@ -566,15 +807,25 @@ class HTTPAPIWrapper:
         if type(upload_fields) is not dict:
             raise Exception('Upload fields must be a dict, and one that comes from _upload_extension')
         types.assert_strs(upload_url, file_path)
-        with open(file_path, 'rb') as f:
-            files = {'file': (file_path, f)}
-            full_url = upload_url + upload_fields.get("key")
-            logger.opt(colors=True).info(f"<fg 160,0,240>{('file upload: '+upload_url+' '+str(files)).replace('<', '&lt;').replace('>', '&gt;')}</>")
-
-            #SECOND answer on: https://stackoverflow.com/questions/57553738/how-to-aiohttp-request-post-files-list-python-requests-module
-            upload_fields['file'] = f.read()
-            _ = await self._checked_get_or_post(upload_url, the_request=None, is_post=True, requests_kwargs={'data':upload_fields}, good_message=f'Successfully uploaded {file_path} to {full_url}', bad_message=f'failed to upload {file_path}', raise_errors=False)
-            return full_url
+        full_url = upload_url + upload_fields.get("key")
+        logger.opt(colors=True).info(f"<fg 160,0,240>{('file upload: '+upload_url+' '+file_path+f' ({os.path.getsize(file_path)} bytes)').replace('<', '&lt;').replace('>', '&gt;')}</>")
+
+        opened = []
+        def _make_form():
+            """Returns a new FormData with the fields and then the file. A form can only be sent once, so each attempt makes its own."""
+            form = aiohttp.FormData()
+            for k, v in upload_fields.items():
+                form.add_field(k, v)
+            f = open(file_path, 'rb')
+            opened.append(f)
+            form.add_field('file', f, filename=os.path.basename(file_path)) # The bucket wants the file after all the other fields.
+            return form
+        try:
+            _ = await self._checked_get_or_post(upload_url, the_request=None, is_post=True, requests_kwargs={'data':_make_form}, good_message=f'Successfully uploaded {file_path} to {full_url}', bad_message=f'failed to upload {file_path}', raise_errors=False)
+        finally:
+            for f in opened:
+                f.close()
+        return full_url
 
     async def upload(self, file_path):
         """Accepts a file_path. Uploads the file at local path file_path to the Moobius server. Automatically calculates the upload URL and upload fields.
@@ -594,7 +845,9 @@ class HTTPAPIWrapper:
 
     async def convert_to_url(self, file_path):
         """Accepts a file_path. Uploads and returns the bucket's url. Idempotent: If given a URL will just return the URL.
-        Empty, False, or None strings are converted to a default URL."""
+        Empty, False, or None strings are converted to a default URL.
+        A file whose content was uploaded before (or is being uploaded right now) is not uploaded again; with an upload_cache this holds across restarts,
+        and an unchanged file (same path, size and modification time) is not even re-read. See upload_many() for converting several files at once."""
         if not file_path:
             return f"https://{types.S3BUCKET}.amazonaws.com/LogoLight.jpg"
         if 'https://' in file_path or 'http://' in file_path or 'ftp://' in file_path or 'ftps://' in file_path:
@@ -602,34 +855,119 @@ class HTTPAPIWrapper:
         elif not os.path.exists(file_path):
             raise Exception(f'Cannot find this local file to upload: {os.path.realpath(file_path)}')
         else:
-            with open(file_path, 'rb') as f:
-                the_bytes = f.read()
-            the_hash = hashlib.sha256(the_bytes).hexdigest()
-            if the_hash not in self.filehash2URL:
-                self.filehash2URL[the_hash] = await self.upload(file_path)
+            the_hash = await self._file_hash(file_path)
+            return await self._url_for_content(the_hash, file_path)
+
+    async def _file_hash(self, file_path):
+        """Returns the SHA-256 of a file, from the upload_cache if this version of the file was hashed before, otherwise by reading it (off the event loop)."""
+        stat = os.stat(file_path)
+        the_hash = self.upload_cache.hash_for(file_path, stat) if self.upload_cache else None
+        if not the_hash:
+            the_hash = await asyncio.to_thread(file_sha256, file_path) # Reads in chunks, off the event loop.
+            if self.upload_cache:
+                self.upload_cache.remember_hash(file_path, stat, the_hash)
+        return the_hash
+
+    async def _url_for_content(self, the_hash, file_path):
+        """
+        Returns the URL of the content with a given SHA-256, uploading it from file_path only if it was not uploaded before.
+        If the same content is already being uploaded (from any path) this waits for that upload instead of starting another.
+        """
+        if the_hash in self.filehash2URL:
             return self.filehash2URL[the_hash]
+        task = self._uploading.get(the_hash)
+        if task is None:
+            task = asyncio.ensure_future(self._upload_content(the_hash, file_path))
+            self._uploading[the_hash] = task
+            task.add_done_callback(lambda _: self._uploading.pop(the_hash, None))
+        return await asyncio.shield(task) # One caller being cancelled does not cancel the upload for the others.
+
+    async def _upload_content(self, the_hash, file_path):
+        """Looks the content up in the upload_cache, or else uploads file_path. Remembers and returns the URL."""
+        url = self.upload_cache.url_for(the_hash) if self.upload_cache else None
+        if not url:
+            url = await self.upload(file_path)
+            if self.upload_cache:
+                self.upload_cache.remember_url(the_hash, url)
+        self.filehash2URL[the_hash] = url
+        return url
+
+    async def upload_many(self, file_paths, max_concurrency=None):
+        """
+        Converts many file paths to URLs at once, like convert_to_url on each (URLs stay as they are).
+        Files are hashed and uploaded concurrently, and identical content (even under different paths) is only uploaded once.
 
-    async def download_size(self, url, headers=None):
-        """Gets the download size in bytes given a url and optional headers. Queries for the header and does not download the file. Returns the number of bytes."""
+        Parameters:
+          file_paths: A list of local file paths and/or URLs.
+          max_concurrency=None: The most files hashed or uploaded at the same time. None uses self.upload_concurrency.
+
+        Returns:
+          The list of URLs, in the same order as file_paths.
+
+        Raises:
+          An Exception if any of the files cannot be found or uploaded.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or self.upload_concurrency)
+        async def _convert(file_path):
+            """Converts one path while holding a slot of the semaphore."""
+            async with semaphore:
+                return await self.convert_to_url(file_path)
+        unique_paths = list(dict.fromkeys(file_paths))
+        path2url = dict(zip(unique_paths, await asyncio.gather(*[_convert(file_path) for file_path in unique_paths])))
+        return [path2url[file_path] for file_path in file_paths]
+
+    def _download_kwargs(self, headers):
+        """Given the headers argument of the download functions (None, "self", or a dict of headers), returns the kwargs for the aiohttp request."""
         if headers is None: # These buckets are public so no need to upload.
-            headers = {}
+            return {}
         if headers == 'self':
-            headers={'headers':self.headers} # Auth allows downloading form buckets we authed for.
+            return {'headers':self.headers} # Auth allows downloading form buckets we authed for.
+        if list(headers) == ['headers']: # Already in kwarg form.
+            return headers
+        return {'headers':headers}
+
+    async def download_size(self, url, headers=None):
+        """Gets the download size in bytes given a url and optional headers. Queries for the header and does not download the file. Returns the number of bytes."""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.head(url, **headers) as response:
-                    if 'Content-Length' in response.headers:
-                        file_size = int(response.headers['Content-Length'])
-                        return file_size
-                    else:
-                        logger.warning("Content-Length not found in headers.")
-                        return None
+            session = await self.session()
+            async with session.head(url, **self._download_kwargs(headers)) as response:
+                if 'Content-Length' in response.headers:
+                    file_size = int(response.headers['Content-Length'])
+                    return file_size
+                else:
+                    logger.warning("Content-Length not found in headers.")
+                    return None
         except aiohttp.ClientError as e:
             return None
 
-    async def download(self, source, file_path=None, auto_dir=None, overwrite=None, bytes=None, headers=None):
+    async def iter_download(self, source, headers=None, chunk_size=None):
+        """
+        Downloads a file chunk by chunk, for processing the bytes as they arrive without holding the whole file.
+
+        Parameters:
+          source: The url to download from, or a MessageBody which has a .content.path in it.
+          headers=None: Optional headers, or "self" to use this instance's auth headers. See download().
+          chunk_size=None: The largest chunk to yield, in bytes. None uses self.download_chunk_size.
+
+        Returns:
+          An async iterator of bytes objects. Use it with "async for chunk in http_api.iter_download(url)".
+
+        Raises:
+          An Exception if the response status is not 200.
+        """
+        url = _source_url(source)
+        session = await self.session()
+        async with session.get(url, **self._download_kwargs(headers)) as resp:
+            if resp.status != 200:
+                raise Exception(f'Cannot download file: {resp}')
+            async for chunk in resp.content.iter_chunked(chunk_size or self.download_chunk_size):
+                yield chunk
+
+    async def download(self, source, file_path=None, auto_dir=None, overwrite=None, bytes=None, headers=None, parallel=None):
         """
         Downloads a file from a url or other source to a local filename, automatically creating dirs if need be.
+        The file is streamed to file_path+".part" which is renamed into place once complete, so file_path never holds a partial download.
+        A dropped connection continues from the bytes already downloaded (using HTTP Range), as does calling download() again after it failed.
 
         Parameters:
           source: The url to download the file from. OR a MessageBody which has a .content.path in it.
@@ -645,54 +983,36 @@ class HTTPAPIWrapper:
           headers=None:
             Optional headers. Use these for downloads that require auth.
             Can set to "self" to use the same auth headers that this instance is using.
+          parallel=None:
+            How many ranges of a large file to fetch at once, if the server supports ranges. None uses self.download_parallel.
 
         Returns:
           The full filepath if bytes if false, otherwise the file's content bytes if bytes=True.
         """
+        url = _source_url(source)
+        if bytes:
+            session = await self.session()
+            async with session.get(url, **self._download_kwargs(headers)) as resp:
+                if resp.status != 200:
+                    raise Exception(f'Cannot download file: {resp}')
+                return await resp.read() # aiohttp collects the body once; no extra copy.
+
         full_path = file_path
-        if headers is None: # These buckets are public so no need to upload.
-            headers = {}
-        if headers == 'self':
-            headers={'headers':self.headers} # Auth allows downloading form buckets we authed for.
         if not full_path:
             if not auto_dir:
                 auto_dir = './downloads'
             full_path = auto_dir+'/'+datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f") + '_' + str(random.randint(1000, 9999))
-        if type(source) is str:
-            url = source
-        elif type(source) is MessageBody:
-            if hasattr(source.content, 'path') and source.content.path:
-                url = source.content.path
-            else:
-                raise Exception("This message does not have a path in it's content.")
-        else:
-            raise Exception(f"Source must be a str or MessageBody, not a {type(source)}")
         full_path = os.path.realpath(full_path).replace('\\','/')
         if not '.' in full_path.split('/')[-1]:
             url_leaf = url.split('/')[-1]
             if '.' in url_leaf: # Infer the extension from the url.
                 full_path = full_path+'.'+url_leaf.split('.')[-1]
+        if os.path.exists(full_path) and not overwrite:
+            raise Exception(f'Assert no overwrite to pre-existing file: {full_path}')
 
-        # https://stackoverflow.com/questions/35388332/how-to-download-images-with-aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, **headers) as resp:
-                if resp.status == 200:
-                    if bytes:
-                        buffer = io.BytesIO()
-                        async for chunk in resp.content.iter_chunked(10):
-                            buffer.write(chunk)
-                        buffer.seek(0)
-                        return buffer.getvalue()
-                    else:
-                        os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                        if os.path.exists(full_path) and not overwrite:
-                            raise Exception(f'Assert no overwrite to pre-existing file: {full_path}')
-                        with open(full_path, 'wb') as fd:
-                            async for chunk in resp.content.iter_chunked(10):
-                                fd.write(chunk)
-                else:
-                    raise Exception(f'Cannot download file: {resp}')
-        return full_path
+        ranged = RangedDownload(await self.session(), url, self._download_kwargs(headers), full_path, chunk_size=self.download_chunk_size, retry_policy=self.retry_policy,
+                                max_attempts=self.download_attempts, parallel=parallel or self.download_parallel, parallel_min_size=self.download_parallel_min_size)
+        return await ranged.run()
 
     ############################# Groups ############################
 
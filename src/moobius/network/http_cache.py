@@ -0,0 +1,125 @@
+# A small in-memory cache for platform queries whose answers rarely change (character profiles, agent lists, channel lists, group members).
+# Each endpoint has its own time-to-live and the cache holds a bounded number of responses, evicting the least recently used.
+# Writes made through the HTTPAPIWrapper drop the cached reads they affect, and the Moobius class drops a channel's entries on join/leave/update payloads.
+# This module is designed to be used by the HTTPAPIWrapper.
+
+import collections, copy, json, time
+
+# Path (relative to the http_server_uri, without the query string) => seconds a successful response stays cached.
+DEFAULT_CACHE_TTLS = {
+    '/character/fetch_profile': 60,
+    '/service/character/list': 60,
+    '/service/list': 300,
+    '/channel/list': 60,
+    '/channel/character_list': 30,
+    '/user/group': 30,
+    '/service/group': 300,
+}
+
+READ_POSTS = ('/character/fetch_profile',) # POST endpoints that only read, so they can be cached like a GET.
+
+# Path of a POST that changes something => the cached paths it makes stale.
+WRITE_INVALIDATES = {
+    '/user/info': ['/character/fetch_profile'],
+    '/service/create': ['/service/list'],
+    '/service/character/create': ['/service/character/list'],
+    '/service/character/update': ['/service/character/list', '/character/fetch_profile'],
+    '/channel/create': ['/channel/list'],
+    '/channel/update': ['/channel/list'],
+    '/service/bind': ['/channel/list'],
+    '/service/unbind': ['/channel/list'],
+}
+
+
+def path_of(http_server_uri, url):
+    """Returns the path of a url on the platform at http_server_uri, without the query string, or None if the url is not on the platform."""
+    http_server_uri = http_server_uri.rstrip('/')
+    if not url.startswith(http_server_uri):
+        return None
+    path = url[len(http_server_uri):].split('?')[0].rstrip('/')
+    return path if path.startswith('/') else '/'+path
+
+
+class ResponseCache:
+    """
+    (This class is for internal use).
+    A size-bounded LRU cache of response dicts with a time-to-live per endpoint path. Responses are copied in and out, so callers can modify them.
+    """
+
+    def __init__(self, http_server_uri, ttls=None, max_entries=1024):
+        """
+        Accepts the platform's http_server_uri, optional ttls which are merged over DEFAULT_CACHE_TTLS (a ttl of 0 or None stops caching that path),
+        and the most responses to keep.
+        """
+        ttls = {**DEFAULT_CACHE_TTLS, **(ttls or {})}
+        self.http_server_uri = http_server_uri.rstrip('/')
+        self.ttls = {k: v for k, v in ttls.items() if v}
+        self.max_entries = max(1, int(max_entries))
+        self.entries = collections.OrderedDict() # key => (expires_at, path, response_dict); the least recently used first.
+        self.counters = {'hits':0, 'misses':0, 'stores':0, 'evictions':0, 'expirations':0, 'invalidations':0}
+
+    def path_of(self, url):
+        """Returns the path of a platform url without the query string, or None if the url is not on the platform."""
+        return path_of(self.http_server_uri, url)
+
+    def key_for(self, url, is_post, requests_kwargs):
+        """Returns (key, ttl) for a request, or (None, None) if its responses are not cached."""
+        path = self.path_of(url)
+        ttl = self.ttls.get(path)
+        if not ttl or (is_post and path not in READ_POSTS):
+            return None, None
+        return (is_post, url, json.dumps(requests_kwargs, sort_keys=True, default=str)), ttl
+
+    def get(self, key):
+        """Returns a copy of the cached response for a key, or None if there is none or it expired."""
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.entries[key]
+            self.counters['expirations'] += 1
+            entry = None
+        if entry is None:
+            self.counters['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return copy.deepcopy(entry[2])
+
+    def put(self, key, ttl, response_dict):
+        """Caches a copy of a response for ttl seconds, evicting the least recently used entries if full. Returns None."""
+        self.entries[key] = (time.monotonic() + ttl, self.path_of(key[1]), copy.deepcopy(response_dict))
+        self.entries.move_to_end(key)
+        self.counters['stores'] += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def note_write(self, url):
+        """Call after a successful POST. Drops the cached paths that it makes stale, if any. Returns None."""
+        stale = WRITE_INVALIDATES.get(self.path_of(url))
+        if stale:
+            self.invalidate(*stale)
+
+    def invalidate(self, *paths, channel_id=None):
+        """
+        Drops cached responses. Returns how many were dropped.
+
+        Parameters:
+          *paths: Only drop these paths (such as "/channel/list"). None given means every path.
+          channel_id=None: Only drop responses to requests which mention this channel_id.
+        """
+        dropped = [k for k, (_, path, _) in self.entries.items()
+                   if (not paths or path in paths) and (channel_id is None or channel_id in k[1] or channel_id in k[2])]
+        for k in dropped:
+            del self.entries[k]
+        self.counters['invalidations'] += len(dropped)
+        return len(dropped)
+
+    def stats(self):
+        """Returns a dict with the number of entries, the hit rate, and the hits/misses/stores/evictions/expirations/invalidations counters."""
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {'entries': len(self.entries), 'hit_rate': self.counters['hits']/lookups if lookups else None, **self.counters}
+
+    def __str__(self):
+        return f'moobius.ResponseCache(n_entries={len(self.entries)}, max_entries={self.max_entries})'
+    def __repr__(self):
+        return self.__str__()
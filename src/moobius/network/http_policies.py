@@ -0,0 +1,206 @@
+# Retries and circuit breaking for the HTTPAPIWrapper's requests.
+# Transient failures (5xx, 429, dropped connections, timeouts) are retried with exponential backoff and jitter, honoring Retry-After.
+# A GET is always safe to repeat; a POST is only repeated if its endpoint is known to be idempotent, or if the connection failed before anything was sent.
+# Each endpoint has a circuit breaker: after enough failures in a row requests to it fail fast for a while instead of piling up.
+# This module is designed to be used by the HTTPAPIWrapper.
+
+import asyncio, datetime, email.utils, random, time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# Circuit breaker states:
+CLOSED = 'closed' # Requests go through.
+OPEN = 'open' # Requests fail fast.
+HALF_OPEN = 'half_open' # One trial request goes through; its outcome closes or re-opens the circuit.
+
+# POST endpoints which can be sent twice without harm (path suffixes). Sign-in, refresh and profile fetches do not change anything;
+# the updates/binds set a state rather than add to it; a repeated /service/group/create at worst makes an unused group.
+IDEMPOTENT_POSTS = ('/auth/sign_in', '/auth/refresh', '/character/fetch_profile', '/user/info', '/service/character/update',
+                    '/service/bind', '/service/unbind', '/channel/update', '/service/group/create')
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TransientHTTPError(Exception):
+    """Raised by get_or_post for a response with a status worth retrying (such as a 503). Holds the status and the Retry-After delay in seconds (None if not given)."""
+    def __init__(self, status, retry_after=None, url=''):
+        super().__init__(f'HTTP status {status} from {url}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitOpenException(Exception):
+    """Raised instead of sending a request when the endpoint's circuit breaker is open."""
+    pass
+
+
+def endpoint_of(url, is_post):
+    """Returns the endpoint key for a request: the method, host and path, without the query string. Retries and circuit breakers work per endpoint."""
+    parts = urlsplit(url)
+    return f"{'POST' if is_post else 'GET'} {parts.netloc}{parts.path.rstrip('/')}"
+
+
+def parse_retry_after(value):
+    """Given a Retry-After header (seconds or an HTTP date), returns the delay in seconds, or None if it is missing or unreadable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def is_connect_error(exception):
+    """True if the exception means the connection could not be made at all, so the request was never sent and is safe to repeat."""
+    return isinstance(exception, aiohttp.ClientConnectorError)
+
+
+def is_transient(exception):
+    """True if the exception is worth retrying: a retryable status, a dropped connection, or a timeout."""
+    return isinstance(exception, (TransientHTTPError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+
+class RetryPolicy:
+    """
+    (This class is for internal use).
+    Decides whether and when a failed request is tried again.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.25, max_delay=8.0, max_retry_after=60.0, retry_statuses=RETRY_STATUSES, idempotent_posts=IDEMPOTENT_POSTS):
+        """
+        Parameters:
+          max_attempts=3: Attempts in total, including the first one. 1 turns retrying off.
+          base_delay=0.25: Seconds before the first retry. Each retry doubles it, with full jitter.
+          max_delay=8.0: The longest backoff between attempts.
+          max_retry_after=60.0: The longest a Retry-After header is honored for. A longer Retry-After gives up instead.
+          retry_statuses=(429, 500, 502, 503, 504): The HTTP statuses worth retrying.
+          idempotent_posts=IDEMPOTENT_POSTS: The path suffixes of POST endpoints that are safe to repeat.
+        """
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = tuple(retry_statuses)
+        self.idempotent_posts = tuple(idempotent_posts)
+
+    def is_idempotent(self, url, is_post):
+        """True if the request can be sent again without side effects: any GET, and POSTs to the idempotent_posts."""
+        return not is_post or urlsplit(url).path.rstrip('/').endswith(self.idempotent_posts)
+
+    def delay(self, attempt, exception):
+        """
+        Given how many attempts failed so far and the last failure, returns the seconds to wait before the next one,
+        or None if it should not be retried at all because the Retry-After is longer than max_retry_after.
+        """
+        retry_after = getattr(exception, 'retry_after', None)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_retry_after else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**(attempt-1)))
+
+    def should_retry(self, url, is_post, attempt, exception):
+        """True if the request that failed with this exception on this attempt (1 is the first) should be tried again."""
+        if attempt >= self.max_attempts or not is_transient(exception):
+            return False
+        return self.is_idempotent(url, is_post) or is_connect_error(exception)
+
+    def __str__(self):
+        return f'moobius.RetryPolicy(max_attempts={self.max_attempts}, base_delay={self.base_delay}, max_delay={self.max_delay})'
+    def __repr__(self):
+        return self.__str__()
+
+
+class CircuitBreaker:
+    """
+    (This class is for internal use).
+    The circuit for one endpoint. It opens after failure_threshold failures in a row, and fails requests fast while open.
+    After reset_timeout seconds it lets one trial request through, which closes it again if it succeeds.
+    """
+
+    def __init__(self, endpoint, failure_threshold=5, reset_timeout=30.0):
+        """Accepts the endpoint key, how many failures in a row open the circuit, and how many seconds it stays open before a trial request."""
+        self.endpoint = endpoint
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    def allow(self):
+        """True if a request may go out now. While half open only one trial request is allowed at a time."""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self._trial_running:
+                return False
+            self._trial_running = True
+        return True
+
+    def record_success(self):
+        """Closes the circuit. Returns None."""
+        self.state = CLOSED
+        self.failures = 0
+        self._trial_running = False
+
+    def record_failure(self):
+        """Counts a failure, opening the circuit if it was a failed trial or there have been failure_threshold in a row. Returns True if this opened it."""
+        self.failures += 1
+        was_trial, self._trial_running = self._trial_running, False
+        if self.state != OPEN and (was_trial or self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def abandon(self):
+        """Call when a request that was allowed is cancelled before it finished, so a trial request does not block the circuit forever. Returns None."""
+        self._trial_running = False
+
+    def retry_in(self):
+        """Returns the seconds until the next trial request is allowed (0 unless open)."""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def __str__(self):
+        return f'moobius.CircuitBreaker(endpoint={self.endpoint}, state={self.state}, failures={self.failures})'
+    def __repr__(self):
+        return self.__str__()
+
+
+class CircuitBreakers:
+    """
+    (This class is for internal use).
+    One CircuitBreaker per endpoint, made on first use.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, enabled=True):
+        """Accepts the CircuitBreaker settings, and enabled=False to never fail fast."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.enabled = enabled
+        self.breakers = {} # endpoint => CircuitBreaker.
+
+    def get(self, endpoint):
+        """Returns the CircuitBreaker for an endpoint key."""
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout)
+            self.breakers[endpoint] = breaker
+        return breaker
+
+    def stats(self):
+        """Returns a dict from each endpoint that has failed to its state and how many failures in a row it has."""
+        return {k: {'state': b.state, 'failures': b.failures} for k, b in self.breakers.items() if b.failures or b.state != CLOSED}
+
+    def __str__(self):
+        return f'moobius.CircuitBreakers(n_endpoints={len(self.breakers)}, enabled={self.enabled})'
+    def __repr__(self):
+        return self.__str__()
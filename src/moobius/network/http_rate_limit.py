@@ -0,0 +1,139 @@
+# Client-side rate limiting for requests to the platform's HTTP API.
+# Endpoints are grouped into families (such as every /user/group/... path). Each family has a token bucket (a steady rate plus a burst allowance)
+# and a cap on how many of its requests are in flight at once. Waiters are served first-come first-served, so a burst is smoothed out
+# instead of being sent all at once and throttled by the platform. Limiting is opt-in: see the rate_limits kwarg of the HTTPAPIWrapper.
+# This module is designed to be used by the HTTPAPIWrapper.
+
+import asyncio, contextlib, time
+
+# An opt-in preset of family => settings. Each family matches the paths (relative to the http_server_uri) that start with one of its prefixes; everything else is "default".
+#   rate: Requests per second on average. None means no rate limit.
+#   burst: How many requests can go at once after an idle period.
+#   max_concurrency: How many can be in flight at once. None means no cap.
+DEFAULT_RATE_LIMITS = {
+    'default': {'rate': 20.0, 'burst': 40, 'max_concurrency': 16},
+    'group': {'prefixes': ['/user/group', '/service/group'], 'rate': 10.0, 'burst': 20, 'max_concurrency': 8},
+    'character': {'prefixes': ['/character', '/channel/character_list', '/service/character'], 'rate': 10.0, 'burst': 20, 'max_concurrency': 8},
+    'auth': {'prefixes': ['/auth'], 'rate': 2.0, 'burst': 5, 'max_concurrency': 2},
+}
+
+
+class FamilyLimiter:
+    """
+    (This class is for internal use).
+    The token bucket and concurrency cap of one endpoint family, with counters of how long requests waited.
+    """
+
+    def __init__(self, name, rate=None, burst=1, max_concurrency=None):
+        """Accepts the family name, the requests per second (None for no limit), the burst size, and the concurrency cap (None for no cap)."""
+        self.name = name
+        self.rate = rate if rate else None
+        self.burst = max(1, int(burst))
+        self.max_concurrency = max_concurrency
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self._token_lock = asyncio.Lock() # Waiters for a token queue up in order on this lock.
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self.counters = {'requests':0, 'waited':0, 'wait_seconds':0.0, 'max_wait_seconds':0.0, 'in_flight':0, 'queued':0}
+
+    async def _take_token(self):
+        """Waits until the bucket has a token and takes it. Returns None."""
+        if self.rate is None:
+            return
+        async with self._token_lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at)*self.rate)
+                self.updated_at = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens)/self.rate)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Async context manager: waits for a concurrency slot and then a token, and holds the slot until the block exits."""
+        counters = self.counters
+        counters['queued'] += 1
+        t0 = time.monotonic()
+        try:
+            if self._semaphore is not None:
+                await self._semaphore.acquire()
+            try:
+                await self._take_token()
+            except BaseException:
+                if self._semaphore is not None:
+                    self._semaphore.release()
+                raise
+        finally:
+            counters['queued'] -= 1
+        waited = time.monotonic() - t0
+        counters['requests'] += 1
+        if waited > 0.001:
+            counters['waited'] += 1
+            counters['wait_seconds'] += waited
+            counters['max_wait_seconds'] = max(counters['max_wait_seconds'], waited)
+        counters['in_flight'] += 1
+        try:
+            yield
+        finally:
+            counters['in_flight'] -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def __str__(self):
+        return f'moobius.FamilyLimiter(name={self.name}, rate={self.rate}, burst={self.burst}, max_concurrency={self.max_concurrency})'
+    def __repr__(self):
+        return self.__str__()
+
+
+class HTTPRateLimiter:
+    """
+    (This class is for internal use).
+    Sorts platform requests into endpoint families and makes each request wait for its family's FamilyLimiter.
+    Requests to other hosts (such as file uploads to the bucket) are not limited.
+    """
+
+    def __init__(self, http_server_uri, rate_limits=None):
+        """
+        Accepts the platform's http_server_uri and optional rate_limits, which are merged over DEFAULT_RATE_LIMITS family by family
+        (a family's settings can be partly given; a new family needs "prefixes"). A family set to None is removed.
+        """
+        families = {k: dict(v) for k, v in DEFAULT_RATE_LIMITS.items()}
+        for name, settings in (rate_limits or {}).items():
+            if settings is None:
+                families.pop(name, None)
+            else:
+                families[name] = {**families.get(name, {}), **settings}
+        families.setdefault('default', {'rate': None, 'max_concurrency': None})
+        self.http_server_uri = http_server_uri.rstrip('/')
+        self.limiters = {name: FamilyLimiter(name, v.get('rate'), v.get('burst', 1), v.get('max_concurrency')) for name, v in families.items()}
+        self._prefixes = sorted([(p, name) for name, v in families.items() for p in v.get('prefixes', [])], key=lambda x: -len(x[0])) # Longest prefix wins.
+
+    def family_of(self, url):
+        """Returns the family name of a url, or None if the url is not on the platform."""
+        if not url.startswith(self.http_server_uri):
+            return None
+        path = url[len(self.http_server_uri):].split('?')[0]
+        if not path.startswith('/'):
+            path = '/'+path
+        for prefix, name in self._prefixes:
+            if path.startswith(prefix):
+                return name
+        return 'default'
+
+    def slot(self, url):
+        """Returns an async context manager which waits for the url's family to allow another request, and holds a slot until it exits."""
+        family = self.family_of(url)
+        if family is None:
+            return contextlib.nullcontext()
+        return self.limiters[family].slot()
+
+    def stats(self):
+        """Returns a dict from each family to its counters: requests, waited (how many had to wait), wait_seconds (in total), max_wait_seconds, in_flight and queued."""
+        return {name: dict(limiter.counters) for name, limiter in self.limiters.items()}
+
+    def __str__(self):
+        return f'moobius.HTTPRateLimiter(families={list(self.limiters)})'
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,121 @@
+# The inbound dispatcher used by the WSClient.
+# Received payloads are handled by a fixed pool of workers instead of one task per frame.
+# Payloads that share an ordering key (by default the channel) are handled one at a time in the order they arrived, different keys run in parallel.
+# This module is designed to be used by the WSClient.
+
+import asyncio
+from collections import deque
+
+from loguru import logger
+
+BY_CHANNEL = "channel" # Ordering: payloads for the same channel_id are handled in order.
+BY_SENDER = "sender" # Ordering: payloads from the same sender are handled in order.
+ORDERINGS = (BY_CHANNEL, BY_SENDER)
+
+
+def order_key(payload, order_by=BY_CHANNEL):
+    """
+    Given a decoded payload dict and BY_CHANNEL or BY_SENDER, returns the key that payloads which must stay in order share.
+    Returns None if the payload has no such field, such payloads are not ordered relative to anything.
+    """
+    if type(payload) is not dict:
+        return None
+    body = payload.get('body')
+    if type(body) is not dict:
+        return None
+    if order_by == BY_SENDER:
+        return body.get('sender') or body.get('channel_id')
+    return body.get('channel_id')
+
+
+class InboundDispatcher:
+    """
+    (This class is for internal use).
+    Runs a handler on received payloads with at most max_workers running at once and at most max_pending accepted but not yet finished.
+    Each ordering key has its own FIFO backlog and at most one worker is working on a given key at a time.
+    A worker handles one payload and then moves the key to the back of the line, so that one busy channel does not starve the others.
+    """
+
+    def __init__(self, handle, max_workers=16, max_pending=1024):
+        """
+        Creates the dispatcher. The workers are started on the first submit().
+
+        Parameters:
+          handle: An async function that accepts one payload. It should catch its own errors, any that escape are logged.
+          max_workers=16: How many payloads can be handled concurrently.
+          max_pending=1024: How many payloads can be waiting or running before submit() waits for room. None or 0 is unbounded.
+        """
+        self.handle = handle
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max_pending
+        self._key2backlog = {} # Backlog for each key that has a payload waiting or running.
+        self._ready_keys = asyncio.Queue() # Keys with a backlog that no worker is working on.
+        self._room = asyncio.Semaphore(max_pending) if max_pending else None
+        self._workers = []
+        self.counters = {'submitted':0, 'handled':0, 'errors':0, 'waited_for_room':0, 'peak_pending':0}
+
+    def pending(self):
+        """Returns how many payloads have been submitted but not finished."""
+        return self.counters['submitted'] - self.counters['handled']
+
+    def is_saturated(self):
+        """Returns True if max_pending payloads are queued or running, so that submit() waits for room (and the socket is not being read meanwhile)."""
+        return self._room is not None and self._room.locked()
+
+    def stats(self):
+        """Returns a dict with the pending count, how many keys have a backlog, and the submitted/handled/errors/waited_for_room/peak_pending counters."""
+        return {'pending': self.pending(), 'active_keys': len(self._key2backlog), **self.counters}
+
+    async def submit(self, payload, key=None):
+        """
+        Queues a payload to be handled after all earlier payloads with the same key. Returns None.
+        A key of None means the payload is not ordered relative to anything.
+        Waits if max_pending payloads are already queued or running, which stops the caller from reading more off the socket.
+        """
+        if self._room is not None:
+            if self._room.locked():
+                self.counters['waited_for_room'] += 1
+            await self._room.acquire()
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._work()) for _ in range(self.max_workers)]
+        if key is None:
+            key = object() # Unique, so it never waits on anything.
+        self.counters['submitted'] += 1
+        self.counters['peak_pending'] = max(self.counters['peak_pending'], self.pending())
+        backlog = self._key2backlog.get(key)
+        if backlog is not None: # A worker or the ready line already has this key.
+            backlog.append(payload)
+            return
+        self._key2backlog[key] = deque([payload])
+        self._ready_keys.put_nowait(key)
+
+    async def _work(self):
+        """One worker: takes a key, handles its oldest payload, and puts the key back in line if there is more. Returns Never."""
+        while True:
+            key = await self._ready_keys.get()
+            backlog = self._key2backlog[key]
+            payload = backlog.popleft()
+            try:
+                await self.handle(payload)
+            except Exception as e:
+                self.counters['errors'] += 1
+                logger.error(f'Inbound handler failed: {e}; {type(e)}')
+            finally:
+                self.counters['handled'] += 1
+                if self._room is not None:
+                    self._room.release()
+            if backlog:
+                self._ready_keys.put_nowait(key)
+            else:
+                del self._key2backlog[key]
+
+    def close(self):
+        """Cancels the workers. Payloads still waiting are discarded. Returns None."""
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    def __str__(self):
+        return f'moobius.InboundDispatcher(max_workers={self.max_workers}, pending={self.pending()}, active_keys={len(self._key2backlog)})'
+    def __repr__(self):
+        return self.__str__()
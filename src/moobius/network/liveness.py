@@ -0,0 +1,130 @@
+# Detects dead websocket connections quickly with protocol-level ping/pong.
+# A connection that is receiving traffic is alive, so pings are only sent when it has been quiet for a while.
+# A missed pong makes the next probe come sooner, and enough missed pongs in a row mark the socket as dead so that the WSClient reconnects.
+# While inbound handling is backed up the WSClient stops reading the socket, so pongs queue up unread behind other frames: no probes are counted then.
+# This module is designed to be used by the WSClient.
+
+import asyncio, time
+
+from loguru import logger
+
+
+class LivenessMonitor:
+    """
+    (This class is for internal use).
+    Pings the WSClient's socket when it has been idle for interval seconds and measures the round-trip time.
+    How long it waits for a pong adapts to the measured round-trip time (between min_timeout and timeout seconds).
+    After max_missed pongs in a row do not arrive it calls ws_client._mark_disconnected(), which aborts the socket and makes receive() reconnect.
+    Nothing is pinged or counted as missed while ws_client.inbound_dispatcher is saturated, since a pong cannot be read until it has room again.
+    """
+
+    def __init__(self, ws_client, interval=5.0, timeout=4.0, max_missed=2, min_timeout=1.0):
+        """
+        Creates the monitor. It is started by start(), which the WSClient calls once connected.
+
+        Parameters:
+          ws_client: The WSClient to watch.
+          interval=5.0: Seconds of silence before a ping is sent.
+          timeout=4.0: The longest wait for a pong.
+          max_missed=2: How many missed pongs in a row count as a dead connection.
+          min_timeout=1.0: The shortest wait for a pong, however small the round-trip time.
+        """
+        self.ws_client = ws_client
+        self.interval = interval
+        self.timeout = timeout
+        self.max_missed = max(1, int(max_missed))
+        self.min_timeout = min(min_timeout, timeout)
+        self.missed = 0
+        self.srtt = None # Smoothed round-trip time in seconds.
+        self.last_rtt = None
+        self.last_received = time.monotonic()
+        self._task = None
+        self.counters = {'pings':0, 'pongs':0, 'missed':0, 'dead_detected':0, 'paused':0}
+
+    def note_received(self):
+        """Call whenever anything arrives on the socket: it proves the connection is alive. Returns None."""
+        self.last_received = time.monotonic()
+
+    def pong_timeout(self):
+        """Returns how long to wait for a pong: four smoothed round-trip times, kept between min_timeout and timeout."""
+        if self.srtt is None:
+            return self.timeout
+        return min(self.timeout, max(self.min_timeout, 4*self.srtt))
+
+    def _backpressured(self, waited_before):
+        """Given the dispatcher's waited_for_room count from before a probe, returns True if the socket was not being read at some point since then."""
+        dispatcher = self.ws_client.inbound_dispatcher
+        return dispatcher.is_saturated() or dispatcher.counters['waited_for_room'] != waited_before
+
+    def _next_delay(self):
+        """Returns how long to sleep before the next check. Shorter after each missed pong so a dead socket is confirmed quickly."""
+        if self.missed:
+            return max(0.5, self.interval / 2**self.missed)
+        return max(0.0, self.interval - (time.monotonic() - self.last_received))
+
+    def start(self):
+        """Starts the monitoring loop if it is not running yet. Must be called from inside the event loop. Returns None."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def _ping(self, websocket):
+        """Pings once and waits for the pong. Returns the round-trip time in seconds, or None if the pong did not come in time."""
+        self.counters['pings'] += 1
+        t0 = time.perf_counter()
+        try:
+            pong_waiter = await websocket.ping()
+            await asyncio.wait_for(pong_waiter, self.pong_timeout())
+        except Exception: # A timeout or a socket that is already closing.
+            return None
+        return time.perf_counter() - t0
+
+    async def _loop(self):
+        """Waits for the socket to be idle, pings it, and marks it dead after max_missed missed pongs. Returns Never."""
+        while True:
+            await asyncio.sleep(self._next_delay())
+            client = self.ws_client
+            if not client.is_connected:
+                self.missed = 0
+                await client.ready_event.wait()
+                self.note_received() # A fresh connection gets a full interval.
+                continue
+            if not self.missed and time.monotonic() - self.last_received < self.interval:
+                continue # Traffic arrived while sleeping.
+            if client.inbound_dispatcher.is_saturated():
+                self.counters['paused'] += 1
+                self.missed = 0
+                self.note_received() # The socket is not being read, so it is not idle; probe again once the handlers catch up.
+                continue
+            websocket = client.websocket
+            waited_before = client.inbound_dispatcher.counters['waited_for_room']
+            rtt = await self._ping(websocket)
+            if rtt is not None:
+                self.counters['pongs'] += 1
+                self.missed = 0
+                self.last_rtt = rtt
+                self.srtt = rtt if self.srtt is None else 0.875*self.srtt + 0.125*rtt
+                self.note_received()
+                continue
+            if self._backpressured(waited_before):
+                self.counters['paused'] += 1
+                self.missed = 0 # The pong may be sitting unread behind the backlog.
+                self.note_received()
+                continue
+            self.missed += 1
+            self.counters['missed'] += 1
+            if self.missed < self.max_missed:
+                logger.info(f'No pong from the websocket{client.report_str} within {self.pong_timeout():.2f}s ({self.missed}/{self.max_missed}), probing again soon.')
+                continue
+            logger.warning(f'Websocket{client.report_str} missed {self.missed} pongs in a row, treating the connection as dead and reconnecting.')
+            self.counters['dead_detected'] += 1
+            self.missed = 0
+            client._mark_disconnected(websocket, abort=True)
+
+    def stats(self):
+        """Returns a dict with the last and smoothed round-trip times in seconds, the current pong timeout, and the pings/pongs/missed/dead_detected/paused counters."""
+        return {'last_rtt': self.last_rtt, 'srtt': self.srtt, 'pong_timeout': self.pong_timeout(), **self.counters}
+
+    def __str__(self):
+        return f'moobius.LivenessMonitor(interval={self.interval}, srtt={self.srtt})'
+    def __repr__(self):
+        return self.__str__()
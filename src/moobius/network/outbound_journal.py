@@ -0,0 +1,241 @@
+# An append-only on-disk journal for the WSClient outbound queue, so that messages queued during an outage survive a restart.
+# Each queued (non-control) frame is appended as a record, and a commit record is appended once the server has acknowledged it
+# (or once it has been sent, for frames without a request_id, which are never acknowledged), or when it is dropped on purpose.
+# The journal is split into segment files. A segment is deleted once every frame in it (and in every older segment) is committed.
+# On start-up the segments are read with mmap and the frames that were never committed are handed back, in order, to be re-queued.
+# This module is designed to be used by the WSClient.
+
+import asyncio, concurrent.futures, mmap, os, struct
+
+from loguru import logger
+
+from moobius.network import outbound_queue
+
+ALWAYS = "always" # Fsync policy: every append is written and fsynced before send() returns. Safest, slowest.
+BATCH = "batch" # Fsync policy: appends made in the same event loop iteration are written together and fsynced in a worker thread.
+NEVER = "never" # Fsync policy: appends are written in batches but left to the OS to flush.
+FSYNC_POLICIES = (ALWAYS, BATCH, NEVER)
+
+_FRAME = 1 # Record kind: a queued frame.
+_COMMIT = 2 # Record kind: the frame with this seq no longer needs to be sent.
+_HEADER = struct.Struct('<BBQI') # kind, lane index, seq, length of the frame bytes that follow.
+_LANES = outbound_queue.LANES
+_SUFFIX = '.seg'
+
+
+class OutboundJournal:
+    """
+    (This class is for internal use).
+    A segmented append-only log of outbound frames. Use append() when a frame is queued and commit() once it is delivered.
+    The frames that were never committed by a previous run are in self.recovered as a list of (seq, lane, frame) tuples.
+    """
+
+    def __init__(self, directory, fsync=BATCH, segment_max_bytes=8<<20):
+        """
+        Opens (or creates) the journal in a directory, reads back what a previous run left behind, and starts a new segment.
+
+        Parameters:
+          directory: The folder the segment files are kept in. One folder per WSClient.
+          fsync="batch": One of ALWAYS, BATCH or NEVER.
+          segment_max_bytes=8<<20: A new segment is started once the current one is this big.
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise Exception(f'Unknown journal fsync policy {fsync}, must be one of {FSYNC_POLICIES}')
+        self.directory = directory
+        self.fsync = fsync
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._segments = {} # Segment number => set of seqs in that segment that are not committed. Dicts keep the insertion (oldest first) order.
+        self._seq2segment = {}
+        self._buffer = bytearray() # Records waiting for the next flush().
+        self._flush_scheduled = False
+        self._fd = None
+        self._fsync_executor = None # One worker thread, so that a slow disk never stalls the event loop.
+        self._fsync_future = None # The fsync in progress, if any.
+        self._unsynced_fds = set() # Written to since the last fsync started.
+        self._retired_fds = [] # Full segments to close once an fsync started after they were retired is done.
+        self._closing_fds = [] # Retired segments the fsync in progress covers.
+        self.counters = {'appended':0, 'committed':0, 'flushes':0, 'fsyncs':0, 'segments_deleted':0}
+        self.recovered, self._next_seq, last_segment = self._load()
+        self._active = last_segment + 1
+        self._active_bytes = 0
+        self._open_active()
+        self._compact()
+        if self.recovered:
+            logger.info(f'Outbound journal {directory} has {len(self.recovered)} unsent messages from a previous run.')
+
+    def _path(self, segment):
+        """Returns the file path of a segment number."""
+        return os.path.join(self.directory, f'{segment:010d}{_SUFFIX}')
+
+    def _load(self):
+        """Reads every segment with mmap. Returns (uncommitted frames as a list of (seq, lane, frame), the next seq, the newest segment number)."""
+        seg_numbers = sorted(int(f[:-len(_SUFFIX)]) for f in os.listdir(self.directory) if f.endswith(_SUFFIX) and f[:-len(_SUFFIX)].isdigit())
+        frames = {} # seq => (lane, frame, segment). Dicts keep the order the frames were appended.
+        next_seq = 0
+        for segment in seg_numbers:
+            self._segments[segment] = set()
+            size = os.path.getsize(self._path(segment))
+            if size == 0:
+                continue
+            with open(self._path(segment), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                offset = 0
+                while offset + _HEADER.size <= size:
+                    kind, lane_ix, seq, length = _HEADER.unpack_from(view, offset)
+                    end = offset + _HEADER.size + length
+                    if end > size or kind not in (_FRAME, _COMMIT):
+                        logger.warning(f'Outbound journal segment {self._path(segment)} has a torn record at byte {offset}, ignoring the rest of it.')
+                        break
+                    if kind == _FRAME:
+                        frames[seq] = (_LANES[lane_ix], view[offset+_HEADER.size:end].decode('utf-8'), segment)
+                    else:
+                        frames.pop(seq, None)
+                    next_seq = max(next_seq, seq+1)
+                    offset = end
+        recovered = []
+        for seq, (lane, frame, segment) in frames.items():
+            self._segments[segment].add(seq)
+            self._seq2segment[seq] = segment
+            recovered.append((seq, lane, frame))
+        return recovered, next_seq, (seg_numbers[-1] if seg_numbers else -1)
+
+    def _open_active(self):
+        """Opens the current segment for appending. Returns None."""
+        self._segments.setdefault(self._active, set())
+        self._fd = os.open(self._path(self._active), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _record(self, kind, lane, seq, data=b''):
+        """Adds one record to the write buffer and makes sure it gets flushed. Returns None."""
+        self._buffer += _HEADER.pack(kind, _LANES.index(lane), seq, len(data))
+        self._buffer += data
+        if self.fsync == ALWAYS:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            try:
+                asyncio.get_running_loop().call_soon(self.flush)
+            except RuntimeError: # No event loop: nothing would call flush() later.
+                self.flush()
+
+    def append(self, lane, frame):
+        """Journals a frame (a JSON string) queued in a lane. Returns its seq, which must be passed to commit() once it is sent."""
+        seq = self._next_seq
+        self._next_seq += 1
+        self._seq2segment[seq] = self._active
+        self._segments[self._active].add(seq)
+        self.counters['appended'] += 1
+        self._record(_FRAME, lane, seq, frame.encode('utf-8'))
+        return seq
+
+    def commit(self, seq):
+        """Marks a frame as no longer needing to be sent, deleting old segments that have nothing left in them. Committing twice is harmless. Returns None."""
+        segment = self._seq2segment.pop(seq, None)
+        if segment is None:
+            return
+        self._segments[segment].discard(seq)
+        self.counters['committed'] += 1
+        self._record(_COMMIT, outbound_queue.CONTROL, seq)
+        self._compact()
+
+    def flush(self):
+        """
+        Writes the buffered records with a single write, fsyncs according to the policy, and starts a new segment if the current one is full. Returns None.
+        With the BATCH policy inside an event loop the fsync runs in a worker thread (see _fsync_in_background), otherwise it runs here.
+        """
+        self._flush_scheduled = False
+        if not self._buffer or self._fd is None:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        os.write(self._fd, data)
+        loop = None
+        if self.fsync == BATCH:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+        if loop is not None:
+            self._unsynced_fds.add(self._fd)
+            self._fsync_in_background(loop)
+        elif self.fsync != NEVER:
+            os.fsync(self._fd)
+            self.counters['fsyncs'] += 1
+        self.counters['flushes'] += 1
+        self._active_bytes += len(data)
+        if self._active_bytes >= self.segment_max_bytes:
+            if self._fd in self._unsynced_fds or self._fsync_future is not None:
+                self._retired_fds.append(self._fd) # Closed once its fsync is done.
+            else:
+                os.close(self._fd)
+            self._active += 1
+            self._active_bytes = 0
+            self._open_active()
+            self._compact()
+
+    def _fsync_in_background(self, loop):
+        """Fsyncs the segments written to since the last fsync in the worker thread, unless one is already running,
+        in which case another one starts when it is done. Returns None."""
+        if self._fsync_future is not None or not self._unsynced_fds:
+            return
+        if self._fsync_executor is None:
+            self._fsync_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='moobius-journal')
+        fds, self._unsynced_fds = list(self._unsynced_fds), set()
+        self._closing_fds, self._retired_fds = self._retired_fds, []
+        def _fsync_all():
+            for fd in fds:
+                os.fsync(fd)
+        self._fsync_future = asyncio.wrap_future(self._fsync_executor.submit(_fsync_all), loop=loop)
+        self._fsync_future.add_done_callback(lambda future: self._fsync_done(future, loop))
+
+    def _fsync_done(self, future, loop):
+        """Called on the event loop when a background fsync finishes. Closes the segments it was the last fsync of, and starts the next fsync if needed. Returns None."""
+        self._fsync_future = None
+        if future.cancelled() or future.exception() is not None:
+            logger.warning(f'Outbound journal {self.directory} could not fsync: {None if future.cancelled() else future.exception()}')
+        else:
+            self.counters['fsyncs'] += 1
+        to_close, self._closing_fds = self._closing_fds, []
+        for fd in to_close:
+            os.close(fd)
+        if self._fd is not None:
+            self._fsync_in_background(loop)
+
+    def _compact(self):
+        """Deletes the oldest segments while they are fully committed. Stops at the first one that is not (so commits in newer segments are never lost first). Returns None."""
+        for segment in list(self._segments.keys()):
+            if segment == self._active or self._segments[segment]:
+                break
+            del self._segments[segment]
+            try:
+                os.remove(self._path(segment))
+                self.counters['segments_deleted'] += 1
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Returns a dict with how many frames are not committed, how many segment files there are, and the appended/committed/flushes/fsyncs/segments_deleted counters."""
+        return {'uncommitted': len(self._seq2segment), 'segments': len(self._segments), **self.counters}
+
+    def close(self):
+        """Flushes, fsyncs (unless the policy is NEVER) and closes the segments, waiting for a background fsync to finish. Returns None."""
+        if self._fsync_executor is not None:
+            self._fsync_executor.shutdown(wait=True)
+            self._fsync_executor = None
+        fds = set(self._closing_fds) | set(self._retired_fds) | self._unsynced_fds
+        if self._fd is not None:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            if data:
+                os.write(self._fd, data)
+            fds.add(self._fd)
+        for fd in fds:
+            if self.fsync != NEVER:
+                os.fsync(fd)
+            os.close(fd)
+        self._fd = None
+        self._closing_fds, self._retired_fds, self._unsynced_fds = [], [], set()
+
+    def __str__(self):
+        return f'moobius.OutboundJournal(directory={self.directory}, uncommitted={len(self._seq2segment)})'
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,282 @@
+# The outbound queue used by the WSClient.
+# Messages are sorted into priority lanes so that small control messages (login, heartbeat) are never stuck behind a large backlog.
+# This module is designed to be used by the WSClient.
+
+import asyncio
+from collections import deque
+
+from loguru import logger
+
+from moobius import types
+
+CONTROL = "control" # Lane for logins and heartbeats. Always drained first.
+INTERACTIVE = "interactive" # Lane for chat messages and user actions.
+BULK = "bulk" # Lane for full-state updates (canvas, buttons, style, etc).
+LANES = (CONTROL, INTERACTIVE, BULK)
+DEFAULT_LANE_WEIGHTS = {INTERACTIVE: 4, BULK: 1} # How many interactive messages are sent for each bulk message when both have a backlog.
+BLOCK = "block" # Overflow policy: the producer waits in send() until there is room.
+DROP_OLDEST = "drop_oldest" # Overflow policy: the oldest bulk message (or interactive message if there is no bulk backlog) is discarded.
+COLLAPSE = "collapse" # Overflow policy: discard an update that a newer queued update supersedes, falling back to DROP_OLDEST.
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, COLLAPSE)
+SUPERSEDING_SUBTYPES = {types.UPDATE_CHARACTERS, types.UPDATE_BUTTONS, types.UPDATE_MENU, types.UPDATE_STYLE, types.UPDATE_CANVAS} # Update subtypes that replace the full state the recipients see.
+
+_TYPE2LANE = {types.SERVICE_LOGIN: CONTROL, types.USER_LOGIN: CONTROL, types.HEARTBEAT: CONTROL,
+              types.MESSAGE_UP: INTERACTIVE, types.MESSAGE_DOWN: INTERACTIVE, types.ACTION: INTERACTIVE,
+              types.UPDATE: BULK}
+
+
+def lane_of(message):
+    """Given a dict-valued socket message, returns which lane it belongs in based on message['type']. Unknown types go in the interactive lane."""
+    return _TYPE2LANE.get(message.get('type'), INTERACTIVE)
+
+
+def supersede_key(message):
+    """
+    Given a dict-valued socket message, returns a hashable key shared by messages that replace each other.
+    Full-state update payloads (characters, buttons, menu, style, and canvas) are keyed by (subtype, channel_id, recipients),
+    a newer update with the same key makes an older one obsolete.
+    Returns None for messages which should never be collapsed.
+    """
+    if message.get('type') != types.UPDATE:
+        return None
+    body = message.get('body')
+    if type(body) is not dict or body.get('subtype') not in SUPERSEDING_SUBTYPES or 'channel_id' not in body:
+        return None
+    recipients = body.get('recipients')
+    if type(recipients) is list:
+        recipients = tuple(recipients)
+    return (body['subtype'], body['channel_id'], recipients)
+
+
+class OutboundItem:
+    """(This class is for internal use). One queued message: the JSON string to send plus the metadata the queue needs."""
+    __slots__ = ('frame', 'lane', 'key', 'seq', 'hold', 'kind', 'request_id')
+
+    def __init__(self, frame, lane=INTERACTIVE, key=None, seq=None, hold=False, kind=None, request_id=None):
+        """Accepts the JSON string, the lane name, the supersede_key (None if the message cannot be collapsed),
+        the journal seq (None if not journaled yet), hold (True to keep it in the journal after sending, until whoever set it commits it),
+        the payload kind used for size accounting (None to read the type from the frame), and the request_id the server will acknowledge (None if unknown)."""
+        self.frame = frame
+        self.lane = lane
+        self.key = key
+        self.seq = seq
+        self.hold = hold
+        self.kind = kind
+        self.request_id = request_id
+
+    def __str__(self):
+        return f'moobius.OutboundItem(lane={self.lane}, frame={self.frame[0:64]})'
+    def __repr__(self):
+        return self.__str__()
+
+
+class OutboundQueue:
+    """
+    (This class is for internal use).
+    An asyncio-friendly queue with one FIFO lane per priority class. It has the same get()/get_nowait()/put()/empty()/qsize() methods as asyncio.Queue.
+    The control lane is always drained first. The other lanes are drained by weighted round-robin so that bulk updates still make progress under heavy chat traffic.
+    The queue can be bounded: max_size limits the interactive plus bulk lanes (control messages are never refused), and overflow_policy decides what happens when it is full.
+    With coalesce on, an item whose key matches a not-yet-sent item replaces that item in place instead of growing the queue.
+    With a journal, non-control items are written through to disk when queued and committed when dropped or superseded, or by done() once sent.
+    Held items (those the server acknowledges) are left in the journal by done() until the WSClient releases them on the acknowledgement.
+    """
+
+    def __init__(self, lane_weights=None, max_size=None, overflow_policy=BLOCK, coalesce=True, journal=None):
+        """
+        Creates an empty queue.
+
+        Parameters:
+          lane_weights=None: Optional dict from lane name to weight, which overrides DEFAULT_LANE_WEIGHTS.
+          max_size=None: Maximum number of queued non-control items. None or 0 is unbounded.
+          overflow_policy="block": One of BLOCK, DROP_OLDEST or COLLAPSE.
+          coalesce=True: Replace queued items in place when a newer item with the same supersede_key arrives.
+          journal=None: Optional OutboundJournal to write non-control items through to.
+        """
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise Exception(f'Unknown overflow_policy {overflow_policy}, must be one of {OVERFLOW_POLICIES}')
+        self.lane_weights = {**DEFAULT_LANE_WEIGHTS, **(lane_weights or {})}
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.coalesce = coalesce
+        self.journal = journal
+        self._key2item = {} # The newest queued item for each supersede_key.
+        self.lanes = {lane: deque() for lane in LANES}
+        self._weighted_lanes = [lane for lane in LANES if lane != CONTROL]
+        self._credits = dict(self.lane_weights)
+        self._has_items = asyncio.Event()
+        self._has_room = asyncio.Event()
+        self.counters = {'enqueued':0, 'coalesced':0, 'dropped':0, 'collapsed':0, 'blocked':0, 'peak_depth':0}
+
+    def qsize(self):
+        """Returns the total number of queued items across all lanes."""
+        return sum(len(q) for q in self.lanes.values())
+
+    def _bounded_size(self):
+        """Returns the number of queued items that count towards max_size."""
+        return len(self.lanes[INTERACTIVE]) + len(self.lanes[BULK])
+
+    def _is_full(self):
+        """Returns True if a non-control item would exceed max_size."""
+        return bool(self.max_size) and self._bounded_size() >= self.max_size
+
+    def stats(self):
+        """Returns a dict with the current depth (total and per lane) and the enqueued/coalesced/dropped/collapsed/blocked/peak_depth counters."""
+        return {'depth': self.qsize(), 'lane_depths': {lane: len(q) for lane, q in self.lanes.items()}, **self.counters}
+
+    def _forget(self, item):
+        """Removes the item from the supersede_key index if it is the indexed one. Call whenever an item leaves the queue. Returns None."""
+        if item.key is not None and self._key2item.get(item.key) is item:
+            del self._key2item[item.key]
+
+    def _discard(self, item):
+        """Call when an item leaves the queue without being sent (dropped or superseded). Returns None."""
+        self._forget(item)
+        if self.journal is not None and item.seq is not None:
+            self.journal.commit(item.seq)
+
+    def done(self, items):
+        """Call with the items that were written to the socket, or with held items once they are acknowledged (after clearing hold).
+        Commits them in the journal unless they are held. Returns None."""
+        if self.journal is None:
+            return
+        for item in items:
+            if item.seq is not None and not item.hold:
+                self.journal.commit(item.seq)
+
+    def _count_drop(self, item):
+        """Updates the drop counter given the dropped item and logs sparingly so that a long outage does not flood the logs. Returns None."""
+        self._discard(item)
+        self.counters['dropped'] += 1
+        if self.counters['dropped'] % 1000 == 1:
+            logger.warning(f'Outbound queue full ({self.max_size} messages, policy={self.overflow_policy}), dropped the oldest {item.lane} message. {self.counters["dropped"]} dropped so far.')
+
+    def _drop_oldest(self):
+        """Discards the oldest bulk item, or the oldest interactive item if the bulk lane is empty. Returns None."""
+        for lane in (BULK, INTERACTIVE):
+            if self.lanes[lane]:
+                self._count_drop(self.lanes[lane].popleft())
+                return
+
+    def _collapse_one(self, new_item):
+        """Removes one queued item made obsolete by new_item or by a newer queued item with the same key. Returns True if something was removed."""
+        for lane in (BULK, INTERACTIVE):
+            q = self.lanes[lane]
+            if new_item.key is not None:
+                for i, item in enumerate(q):
+                    if item.key == new_item.key:
+                        self._discard(item)
+                        del q[i]
+                        self.counters['collapsed'] += 1
+                        return True
+            newer_keys = set()
+            for i in range(len(q)-1, -1, -1): # Newest to oldest so that the older duplicate is the one removed.
+                key = q[i].key
+                if key is None:
+                    continue
+                if key in newer_keys:
+                    self._discard(q[i])
+                    del q[i]
+                    self.counters['collapsed'] += 1
+                    return True
+                newer_keys.add(key)
+        return False
+
+    def empty(self):
+        """Returns True if no lane has anything queued."""
+        return not any(self.lanes.values())
+
+    def _pick_lane(self):
+        """Returns the lane to take the next item from, spending one credit of the weighted round-robin. Returns None if empty."""
+        if self.lanes[CONTROL]:
+            return CONTROL
+        candidates = [lane for lane in self._weighted_lanes if self.lanes[lane]]
+        if not candidates:
+            return None
+        for lane in candidates:
+            if self._credits[lane] > 0:
+                self._credits[lane] -= 1
+                return lane
+        self._credits = dict(self.lane_weights) # Everyone with a backlog spent thier credits, start a new round.
+        self._credits[candidates[0]] -= 1
+        return candidates[0]
+
+    def _coalesce_into(self, item):
+        """If coalescing is on and a queued item has the same key, overwrites that item in place with this one's frame. Returns True if it did."""
+        if not self.coalesce or item.key is None:
+            return False
+        old = self._key2item.get(item.key)
+        if old is None:
+            return False
+        old.frame = item.frame
+        old.hold, old.kind, old.request_id = item.hold, item.kind, item.request_id # The frame now carries the new request_id.
+        if self.journal is not None and old.seq is not None:
+            self.journal.commit(old.seq)
+            old.seq = self.journal.append(old.lane, old.frame)
+        self.counters['coalesced'] += 1
+        return True
+
+    async def put(self, item):
+        """Adds an OutboundItem to the tail of its lane, applying the overflow policy if the queue is full. Returns None.
+        If the item supersedes a queued one (see coalesce) the queued one is replaced in place instead."""
+        while True:
+            if self._coalesce_into(item):
+                return
+            if item.lane == CONTROL or not self._is_full():
+                break
+            if self.overflow_policy == BLOCK:
+                self.counters['blocked'] += 1
+                self._has_room.clear()
+                await self._has_room.wait()
+            elif self.overflow_policy == COLLAPSE and self._collapse_one(item):
+                pass
+            else:
+                self._drop_oldest()
+        if self.journal is not None and item.lane != CONTROL and item.seq is None:
+            item.seq = self.journal.append(item.lane, item.frame)
+        self.lanes[item.lane].append(item)
+        if item.key is not None:
+            self._key2item[item.key] = item
+        self.counters['enqueued'] += 1
+        self.counters['peak_depth'] = max(self.counters['peak_depth'], self.qsize())
+        self._has_items.set()
+
+    def put_front(self, items):
+        """Puts a list of OutboundItems back at the head of thier lanes in thier original order, ignoring max_size.
+        Used to return messages that failed to send so that ordering is kept.
+        Items superseded by a newer queued item are not put back when coalescing is on. Returns None."""
+        for item in reversed(items):
+            if self.coalesce and item.key is not None and item.key in self._key2item:
+                self.counters['coalesced'] += 1
+                if self.journal is not None and item.seq is not None:
+                    self.journal.commit(item.seq)
+                continue
+            self.lanes[item.lane].appendleft(item)
+            if item.key is not None and item.key not in self._key2item:
+                self._key2item[item.key] = item
+        if items:
+            self._has_items.set()
+
+    def get_nowait(self):
+        """Returns the next OutboundItem. Raises asyncio.QueueEmpty if there is nothing queued."""
+        lane = self._pick_lane()
+        if lane is None:
+            raise asyncio.QueueEmpty()
+        item = self.lanes[lane].popleft()
+        self._forget(item)
+        if self.empty():
+            self._has_items.clear()
+        if not self._is_full():
+            self._has_room.set()
+        return item
+
+    async def get(self):
+        """Waits for and returns the next OutboundItem."""
+        while self.empty():
+            await self._has_items.wait()
+        return self.get_nowait()
+
+    def __str__(self):
+        sizes = ', '.join(f'{lane}={len(q)}' for lane, q in self.lanes.items())
+        return f'moobius.OutboundQueue({sizes})'
+    def __repr__(self):
+        return self.__str__()
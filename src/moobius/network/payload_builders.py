@@ -0,0 +1,157 @@
+# Fast builders for the websocket payloads that are sent the most (message_up and message_down).
+# The dict-based WSClient.message_up()/message_down() build a dict, strip the None content fields, and then serialize the whole thing.
+# These builders write the JSON string in one pass instead: the constant parts are precompiled once per (type, subtype),
+# only the fields are encoded per message, and a MessageContent is read directly without converting it to a dict.
+# The output has the same keys in the same order as the dict-based builders.
+# FrameTemplate serializes any message once and splices the fields that differ between copies in, which is how broadcasts are sent.
+# This module is designed to be used by the WSClient.
+
+import dataclasses, json, uuid
+
+from moobius import types
+from moobius.types import MessageContent
+
+try:
+    from _json import encode_basestring_ascii as _encode_str # The C version, if this Python has it.
+except ImportError:
+    _encode_str = json.encoder.encode_basestring_ascii
+
+CONTENT_FIELDS = tuple(f.name for f in dataclasses.fields(MessageContent))
+_CONTENT_FIELD_SET = frozenset(CONTENT_FIELDS)
+_CONTENT_KEYS = {k: _encode_str(k)+':' for k in CONTENT_FIELDS} # Precompiled '"text":' etc.
+
+
+def _json_value(v, dumps):
+    """Encodes one JSON value, with fast paths for the str and int fields messages mostly have. Falls back to the dumps function."""
+    if type(v) is str:
+        return _encode_str(v)
+    if type(v) is int:
+        return str(v)
+    return dumps(v)
+
+
+def content_json(content, dumps):
+    """
+    Given a MessageContent (or a dict with MessageContent's fields) and a JSON dumps function, returns the JSON object string with the None fields left out.
+    Raises an Exception if a dict has fields that MessageContent does not, like asserted_dataclass_asdict would.
+    """
+    if type(content) is MessageContent:
+        pairs = [(k, getattr(content, k)) for k in CONTENT_FIELDS]
+    elif type(content) is dict:
+        if not _CONTENT_FIELD_SET.issuperset(content):
+            raise Exception(f'Wrong format for conversion to dataclass {MessageContent}: unknown fields {set(content)-_CONTENT_FIELD_SET}')
+        pairs = content.items()
+    else:
+        raise Exception(f'Wrong format for conversion to dataclass {MessageContent}')
+    return '{' + ','.join(_CONTENT_KEYS[k]+_json_value(v, dumps) for k, v in pairs if v is not None) + '}'
+
+
+class MessageFrameBuilder:
+    """
+    (This class is for internal use).
+    Builds message_up or message_down JSON strings for one subtype. The parts that never change are encoded once, on construction.
+    Get them with builder_for() rather than constructing them directly, so they are reused.
+    """
+
+    def __init__(self, payload_type, subtype):
+        """Accepts types.MESSAGE_UP or types.MESSAGE_DOWN and the message subtype (such as types.TEXT)."""
+        if payload_type not in [types.MESSAGE_UP, types.MESSAGE_DOWN]:
+            raise Exception(f'No fast builder for payload type {payload_type}')
+        self.payload_type = payload_type
+        self.subtype = subtype
+        self.is_down = payload_type == types.MESSAGE_DOWN
+        self._head = '{"type":' + _encode_str(payload_type) + ',"request_id":'
+        self._body_head = ',"body":{"subtype":' + _encode_str(subtype) + ',"channel_id":'
+
+    def build(self, request_id, user_id, service_id, channel_id, recipients, content, timestamp, context, sender, dumps):
+        """Returns the JSON string. The user_id is only used for message_up and the sender only for message_down. The dumps function encodes the context and any unusual values."""
+        parts = [self._head, _encode_str(request_id)]
+        if not self.is_down:
+            parts += [',"user_id":', _encode_str(user_id)]
+        parts += [',"service_id":', _encode_str(service_id),
+                  self._body_head, _encode_str(channel_id),
+                  ',"content":', content_json(content, dumps),
+                  ',"recipients":', _encode_str(recipients),
+                  ',"timestamp":', str(timestamp),
+                  ',"context":', dumps(context) if context else '{}']
+        if self.is_down:
+            parts += [',"sender":', _json_value(sender, dumps)]
+        parts.append('}}')
+        return ''.join(parts)
+
+    def __str__(self):
+        return f'moobius.MessageFrameBuilder(payload_type={self.payload_type}, subtype={self.subtype})'
+    def __repr__(self):
+        return self.__str__()
+
+
+_BUILDERS = {} # (payload_type, subtype) => MessageFrameBuilder.
+
+
+def builder_for(payload_type, subtype):
+    """Returns the (cached) MessageFrameBuilder for a payload type and subtype."""
+    builder = _BUILDERS.get((payload_type, subtype))
+    if builder is None:
+        builder = MessageFrameBuilder(payload_type, subtype)
+        _BUILDERS[(payload_type, subtype)] = builder
+    return builder
+
+
+class FrameTemplate:
+    """
+    (This class is for internal use).
+    A dict-valued message serialized once with placeholders at some string-valued fields, so that copies which only differ in those fields
+    can be made by splicing the JSON-encoded values in. Used to broadcast one payload to many recipient groups.
+    """
+
+    def __init__(self, message, *paths, dumps):
+        """
+        Serializes the message. Does not modify it.
+
+        Parameters:
+          message: The dict-valued message.
+          *paths: One list of keys per field to fill in, such as ['request_id'] or ['body', 'recipients']. Each field must be inside dicts.
+          dumps: The JSON dumps function.
+        """
+        tokens = [f'moobius-placeholder-{i}-{uuid.uuid4().hex}' for i in range(len(paths))] # Plain ASCII, so every codec encodes them the same way.
+        shell = _with_values(message, paths, tokens)
+        self.pieces = [dumps(shell)] # Constant JSON pieces. The slot between pieces[i] and pieces[i+1] is filled with the value of path slot_ixs[i].
+        self.slot_ixs = []
+        for i, token in enumerate(tokens):
+            quoted = '"' + token + '"'
+            for j, piece in enumerate(self.pieces):
+                if quoted in piece:
+                    if piece.count(quoted) != 1:
+                        raise Exception(f'The placeholder for {paths[i]} appears more than once.')
+                    before, after = piece.split(quoted)
+                    self.pieces[j:j+1] = [before, after]
+                    self.slot_ixs.insert(j, i)
+                    break
+            else:
+                raise Exception(f'The field {paths[i]} did not end up in the serialized message.')
+        self.dumps = dumps
+
+    def fill(self, *values):
+        """Given one value per path (in the order the paths were given), returns the JSON string."""
+        out = [self.pieces[0]]
+        for slot, piece in zip(self.slot_ixs, self.pieces[1:]):
+            out.append(_json_value(values[slot], self.dumps))
+            out.append(piece)
+        return ''.join(out)
+
+    def __str__(self):
+        return f'moobius.FrameTemplate(n_slots={len(self.slot_ixs)}, length={sum(len(p) for p in self.pieces)})'
+    def __repr__(self):
+        return self.__str__()
+
+
+def _with_values(message, paths, values):
+    """Returns a copy of the nested dicts along each path (everything else shared, not copied) with the values set at the end of each path."""
+    out = dict(message)
+    for path, value in zip(paths, values):
+        d = out
+        for k in path[:-1]:
+            d[k] = dict(d[k])
+            d = d[k]
+        d[path[-1]] = value
+    return out
@@ -0,0 +1,200 @@
+# Resumable and parallel file downloads using HTTP Range requests.
+# A download is written to "<file>.part" and renamed into place once complete. If the connection drops, the download continues
+# from the bytes already on disk (also on a later call: a small "<file>.part.json" remembers which url and version the bytes belong to,
+# and If-Range makes the server send the whole file again if it changed).
+# Large files can instead be split into several ranges fetched at once, each written at its offset of a preallocated file.
+# This module is designed to be used by the HTTPAPIWrapper.
+
+import asyncio, json, os
+
+import aiohttp
+from loguru import logger
+
+_RESUMABLE_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class RangedDownload:
+    """
+    (This class is for internal use).
+    Downloads one url to one file path, resuming after dropped connections and optionally fetching ranges in parallel. Use run() once.
+    """
+
+    def __init__(self, session, url, request_kwargs, file_path, chunk_size=1<<20, retry_policy=None, max_attempts=4, parallel=1, parallel_min_size=16<<20):
+        """
+        Parameters:
+          session: The aiohttp.ClientSession to use.
+          url: The url to download.
+          request_kwargs: Extra kwargs for session.get() and session.head(), such as {'headers': {...}}.
+          file_path: Where the finished file goes.
+          chunk_size=1<<20: Bytes read from the socket at a time.
+          retry_policy=None: The http_policies.RetryPolicy whose backoff is used between attempts. None retries at once.
+          max_attempts=4: Attempts per stream (or per range), including the first. Each one continues where the last one stopped.
+          parallel=1: How many ranges to fetch at once, if the server supports ranges and the file has at least parallel_min_size bytes.
+          parallel_min_size=16<<20: Smaller files are fetched as one stream.
+        """
+        self.session = session
+        self.url = url
+        self.request_kwargs = request_kwargs
+        self.file_path = file_path
+        self.part_path = file_path + '.part'
+        self.meta_path = file_path + '.part.json'
+        self.chunk_size = chunk_size
+        self.retry_policy = retry_policy
+        self.max_attempts = max(1, int(max_attempts))
+        self.parallel = max(1, int(parallel))
+        self.parallel_min_size = parallel_min_size
+        self.counters = {'attempts':0, 'resumed':0, 'restarted':0, 'ranges':0, 'bytes':0}
+
+    def _kwargs(self, extra_headers):
+        """Returns the request kwargs with extra_headers added to any headers in them."""
+        return {**self.request_kwargs, 'headers': {**self.request_kwargs.get('headers', {}), **extra_headers}}
+
+    async def _backoff(self, attempt, exception):
+        """Logs a dropped connection and sleeps before the next attempt. Returns None."""
+        delay = self.retry_policy.delay(attempt, exception) if self.retry_policy else 0.0
+        logger.warning(f'Download of {self.url} interrupted ({type(exception).__name__}: {exception}), continuing in {delay or 0.0:.2f}s (attempt {attempt+1}/{self.max_attempts}).')
+        await asyncio.sleep(delay or 0.0)
+
+    async def _probe(self):
+        """HEADs the url. Returns (size, accepts_ranges, validator); size and validator are None if unknown. Never raises."""
+        try:
+            async with self.session.head(self.url, allow_redirects=True, **self.request_kwargs) as resp:
+                if resp.status != 200:
+                    return None, False, None
+                size = resp.headers.get('Content-Length')
+                return (int(size) if size and size.isdigit() else None, resp.headers.get('Accept-Ranges', '').lower() == 'bytes',
+                        resp.headers.get('ETag') or resp.headers.get('Last-Modified'))
+        except Exception:
+            return None, False, None
+
+    def _load_meta(self):
+        """Returns the saved {url, validator, size} of a leftover .part file, or None if there is no usable one."""
+        if not (os.path.exists(self.part_path) and os.path.exists(self.meta_path)):
+            return None
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('url') == self.url and meta.get('validator') else None
+
+    def _save_meta(self, validator, size):
+        """Remembers which url and version the .part file holds, so that a later call can continue it. Returns None."""
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'url': self.url, 'validator': validator, 'size': size}, f)
+
+    def _finish(self):
+        """Renames the .part file into place and removes the metadata. Returns None."""
+        os.replace(self.part_path, self.file_path)
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+
+    async def run(self):
+        """Downloads the file. Returns the file path. Raises an Exception on a bad status or when the attempts run out; a .part file that can be continued is kept."""
+        os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        size, accepts_ranges, validator = None, False, None
+        if self.parallel > 1: # Only a parallel download needs the size up front, so a single stream skips the HEAD round trip.
+            size, accepts_ranges, validator = await self._probe()
+        if accepts_ranges and size and size >= self.parallel_min_size:
+            await self._run_parallel(size, validator)
+        else:
+            await self._run_single()
+        self._finish()
+        return self.file_path
+
+    async def _run_single(self):
+        """Streams the file into the .part file, continuing from its end after a dropped connection. Returns None."""
+        meta = self._load_meta()
+        validator = meta['validator'] if meta else None
+        offset = os.path.getsize(self.part_path) if meta else 0
+        if meta and offset:
+            self.counters['resumed'] += 1
+        for attempt in range(1, self.max_attempts+1):
+            self.counters['attempts'] += 1
+            extra = {}
+            if offset:
+                extra['Range'] = f'bytes={offset}-'
+                if validator:
+                    extra['If-Range'] = validator
+            try:
+                async with self.session.get(self.url, **self._kwargs(extra)) as resp:
+                    if resp.status == 416 and meta and offset == meta.get('size'): # The .part file was already complete.
+                        return
+                    if resp.status == 200:
+                        if offset:
+                            self.counters['restarted'] += 1 # The server ignored the Range, or the file changed.
+                        offset = 0
+                    elif resp.status != 206 or not offset:
+                        raise Exception(f'Cannot download file: {resp}')
+                    validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified') or validator
+                    total = resp.content_length + offset if resp.content_length is not None else None
+                    if validator:
+                        self._save_meta(validator, total)
+                    with open(self.part_path, 'r+b' if offset else 'wb') as fd:
+                        fd.seek(offset)
+                        fd.truncate()
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            fd.write(chunk)
+                            offset += len(chunk)
+                            self.counters['bytes'] += len(chunk)
+                    if total is not None and offset < total:
+                        raise aiohttp.ClientPayloadError(f'Connection closed after {offset} of {total} bytes.')
+                    return
+            except _RESUMABLE_ERRORS as e:
+                if attempt == self.max_attempts:
+                    raise
+                if os.path.exists(self.part_path):
+                    offset = os.path.getsize(self.part_path)
+                await self._backoff(attempt, e)
+
+    async def _run_parallel(self, size, validator):
+        """Preallocates the .part file and fetches parallel ranges of it at once. Returns None."""
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path) # A parallel .part file is not continued by a later call.
+        with open(self.part_path, 'wb') as fd:
+            fd.truncate(size)
+        step = -(-size // self.parallel)
+        ranges = [(start, min(size, start+step)-1) for start in range(0, size, step)]
+        self.counters['ranges'] += len(ranges)
+        tasks = [asyncio.ensure_future(self._fetch_range(start, end, validator)) for start, end in ranges]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks: # gather() leaves the other ranges running when one fails.
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True) # None of them may still be writing when the file is removed.
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+            raise
+
+    async def _fetch_range(self, start, end, validator):
+        """Fetches bytes start to end (inclusive) into their place in the .part file, continuing after dropped connections. Returns None."""
+        pos = start
+        for attempt in range(1, self.max_attempts+1):
+            self.counters['attempts'] += 1
+            extra = {'Range': f'bytes={pos}-{end}'}
+            if validator:
+                extra['If-Range'] = validator
+            try:
+                async with self.session.get(self.url, **self._kwargs(extra)) as resp:
+                    if resp.status != 206:
+                        raise Exception(f'Expected a partial response for bytes {pos}-{end} of {self.url} but got {resp}')
+                    with open(self.part_path, 'r+b') as fd:
+                        fd.seek(pos)
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            chunk = chunk[:end+1-pos] # Guard against a server that sends more than asked for.
+                            fd.write(chunk)
+                            pos += len(chunk)
+                            self.counters['bytes'] += len(chunk)
+                    if pos <= end:
+                        raise aiohttp.ClientPayloadError(f'Range closed after {pos-start} of {end+1-start} bytes.')
+                    return
+            except _RESUMABLE_ERRORS as e:
+                if attempt == self.max_attempts:
+                    raise
+                await self._backoff(attempt, e)
+
+    def __str__(self):
+        return f'moobius.RangedDownload(url={self.url}, file_path={self.file_path}, parallel={self.parallel})'
+    def __repr__(self):
+        return self.__str__()
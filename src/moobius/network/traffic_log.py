@@ -0,0 +1,159 @@
+# Logging of the raw frames sent and received on the websocket.
+# Frames can be very large (canvas, characters), so the logger checks whether anything would be printed before doing any work,
+# formats lazily, truncates long frames, and can log only a sample of the frames of a given type.
+# This module is designed to be used by the WSClient.
+
+import re
+
+from loguru import logger
+
+_TYPE_RE = re.compile(r'"type"\s*:\s*"([^"]*)"')
+_TYPE_SCAN_CHARS = 96 # Only the start of the frame is searched for the type. The builders always put "type" first.
+
+
+def frame_type(frame):
+    """Given a JSON string, returns the value of its "type" field if it appears near the start, otherwise "unknown". Does not parse the JSON."""
+    match = _TYPE_RE.search(frame, 0, _TYPE_SCAN_CHARS)
+    return match.group(1) if match else 'unknown'
+
+
+def frame_size(frame):
+    """Given a frame (a str or bytes), returns how many bytes it is before compression. ASCII strings (most JSON) are not encoded to find out."""
+    if type(frame) is str:
+        return len(frame) if frame.isascii() else len(frame.encode('utf-8'))
+    return len(frame)
+
+
+def payload_kind(message):
+    """Given a dict-valued payload, returns its body's subtype (such as "update_canvas") if it has one, otherwise its type (such as "message_up")."""
+    body = message.get('body')
+    if type(body) is dict and body.get('subtype'):
+        return body['subtype']
+    return message.get('type') or 'unknown'
+
+
+class SizeCounters:
+    """(This class is for internal use). Counts frames and bytes sent and received, per payload kind (see payload_kind)."""
+
+    def __init__(self):
+        """Creates zeroed counters."""
+        self.sent = {} # Kind => [frames, bytes].
+        self.received = {}
+
+    @staticmethod
+    def _add(table, kind, n_bytes):
+        """Adds one frame of n_bytes to table[kind]. Returns None."""
+        counts = table.get(kind)
+        if counts is None:
+            table[kind] = [1, n_bytes]
+        else:
+            counts[0] += 1
+            counts[1] += n_bytes
+
+    def add_sent(self, kind, n_bytes):
+        """Counts a frame of n_bytes (see frame_size) written to the socket. Returns None."""
+        self._add(self.sent, kind, n_bytes)
+
+    def add_received(self, kind, n_bytes):
+        """Counts a frame of n_bytes (see frame_size) read from the socket. Returns None."""
+        self._add(self.received, kind, n_bytes)
+
+    def stats(self):
+        """Returns {"sent": {kind: {"frames":..., "bytes":...}}, "received": {...}}. Bytes are UTF-8, before compression."""
+        return {direction: {kind: {'frames': c[0], 'bytes': c[1]} for kind, c in table.items()} for direction, table in [['sent', self.sent], ['received', self.received]]}
+
+
+class TrafficLogger:
+    """
+    (This class is for internal use).
+    Logs socket frames at a configurable level. Configure it with the "traffic_log" dict in the log_config, for example:
+      >>> "log_config": {"traffic_log": {"level": "INFO", "max_chars": 1024, "sample_rates": {"update": 0.1, "heartbeat": 0}}}
+    """
+
+    def __init__(self, level="INFO", max_chars=2048, sample_rates=None, default_rate=1.0, enabled=True):
+        """
+        Creates the traffic logger.
+
+        Parameters:
+          level="INFO": The loguru level the frames are logged at.
+          max_chars=2048: Longer frames are cut off with a note of how many characters were left out. None or 0 does not truncate.
+          sample_rates=None: Dict from payload type (such as "update" or "heartbeat") to the fraction of those frames that are logged. 0 logs none of them.
+          default_rate=1.0: The fraction for types not in sample_rates.
+          enabled=True: False turns traffic logging off completely.
+        """
+        self.level = level.upper()
+        self._level_no = logger.level(self.level).no
+        self.max_chars = max_chars
+        self.enabled_flag = enabled
+        self.default_every = self._every(default_rate)
+        self.type2every = {k: self._every(v) for k, v in (sample_rates or {}).items()}
+        self._type2seen = {}
+        self.counters = {'logged':0, 'sampled_out':0, 'below_level':0}
+
+    @staticmethod
+    def _every(rate):
+        """Converts a sampling fraction into "log one frame out of every N". Returns N, or 0 for never."""
+        if not rate or rate <= 0:
+            return 0
+        return max(1, round(1.0/min(rate, 1.0)))
+
+    def is_enabled(self):
+        """Returns False if no log sink would print a frame at this level. Cheap enough to call for every frame."""
+        if not self.enabled_flag:
+            return False
+        try:
+            return self._level_no >= logger._core.min_level # The lowest level any loguru handler accepts.
+        except AttributeError: # Loguru internals changed, fall back to always formatting.
+            return True
+
+    def _sampled(self, kind):
+        """Counts a frame of type kind. Returns True if this one should be logged."""
+        every = self.type2every.get(kind, self.default_every)
+        if every == 0:
+            self.counters['sampled_out'] += 1
+            return False
+        seen = self._type2seen.get(kind, 0)
+        self._type2seen[kind] = seen + 1
+        if seen % every:
+            self.counters['sampled_out'] += 1
+            return False
+        return True
+
+    def _truncated(self, frame):
+        """Returns the frame, cut to max_chars with a note of how much was cut."""
+        if self.max_chars and len(frame) > self.max_chars:
+            return f'{frame[:self.max_chars]}... ({len(frame)-self.max_chars} more chars)'
+        return frame
+
+    def _log(self, markup, frame, kind, report_str):
+        """Logs one frame, unless it is filtered out by level or sampling. Returns None."""
+        if not self.is_enabled():
+            self.counters['below_level'] += 1
+            return
+        if not self._sampled(kind or frame_type(str(frame))):
+            return
+        self.counters['logged'] += 1
+        # The frame is a formatting argument, not part of the markup, so it needs no escaping and is only truncated if a sink accepts it.
+        logger.opt(colors=True, lazy=True, depth=2).log(self.level, markup, lambda: report_str, lambda: self._truncated(str(frame)))
+
+    def sent(self, frame, report_str='', kind=None):
+        """Logs a frame written to the socket. The type is read from the frame if not given. Returns None."""
+        self._log("<fg 128,0,240>Sent to socket{}: {}</>", frame, kind, report_str)
+
+    def received(self, frame, report_str='', kind=None):
+        """Logs a frame read from the socket. The type is read from the frame if not given. Returns None."""
+        self._log("<yellow>{} {}</yellow>", frame, kind, report_str)
+
+    def sent_batch(self, n_frames, n_chars, report_str=''):
+        """Logs a one-line summary of a batch of frames written together. Returns None."""
+        if self.is_enabled():
+            logger.opt(colors=True, depth=1).log(self.level, "<fg 128,0,240>Sent batch of {} messages ({} chars) to socket{}</>", n_frames, n_chars, report_str)
+
+    def stats(self):
+        """Returns a dict with the logged/sampled_out/below_level counters."""
+        return dict(self.counters)
+
+    def __str__(self):
+        return f'moobius.TrafficLogger(level={self.level}, max_chars={self.max_chars})'
+    def __repr__(self):
+        return self.__str__()
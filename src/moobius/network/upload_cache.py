@@ -0,0 +1,86 @@
+# Remembers uploaded files across restarts, so that convert_to_url() does not upload (or even re-read) a file it already uploaded.
+# Two maps are stored with the same database engines as MoobiusStorage (json files or redis), which processes launched by the wand can share:
+#   The SHA-256 of a file's content => the URL it was uploaded to.
+#   A file's (path, size, modification time) => its SHA-256, so that an unchanged file does not need hashing again.
+# This module is designed to be used by the HTTPAPIWrapper.
+
+import hashlib, os
+
+from loguru import logger
+
+from moobius.database.storage import get_engine
+
+
+class UploadCache:
+    """
+    (This class is for internal use).
+    A persistent content-addressed map of uploaded files, backed by a DatabaseInterface. Lookups that fail for any reason count as misses.
+    """
+
+    def __init__(self, implementation='json', settings=None, domain='upload_cache'):
+        """
+        Parameters:
+          implementation='json': The database engine, as in a db_config entry ("json" or "redis").
+          settings=None: The engine settings, as in a db_config entry. None stores json files under "./json_db".
+            For redis give a "db" number, so that every process uses the same one.
+          domain='upload_cache': The name of the database (a folder for json, a key prefix for redis). Processes using the same one share uploads.
+        """
+        settings = settings if settings is not None else {'root_dir': 'json_db'}
+        engine = get_engine(implementation)
+        self.urls = engine(domain=domain+'.urls', **settings) # hash => {'url': url}
+        self.hashes = engine(domain=domain+'.hashes', **settings) # stat key => {'hash': hash}
+        self.implementation = implementation
+        self.counters = {'url_hits':0, 'url_misses':0, 'hash_hits':0, 'hash_misses':0}
+
+    @staticmethod
+    def _stat_key(file_path, stat):
+        """Returns the key for a file's path, size and modification time. It is hashed so that any path makes a valid database key."""
+        ident = f'{os.path.realpath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+        return hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+    def _get(self, database, key, field):
+        """Returns database[key][field], or None if it is not there or cannot be read."""
+        try:
+            is_success, value = database.get_value(key)
+        except Exception as e:
+            logger.warning(f'Could not read {key} from the upload cache: {e}')
+            return None
+        if not is_success or type(value) is not dict:
+            return None
+        return value.get(field)
+
+    def _set(self, database, key, value):
+        """Stores a value, logging rather than raising if the database fails, since the cache is only an optimization. Returns None."""
+        try:
+            database.set_value(key, value)
+        except Exception as e:
+            logger.warning(f'Could not write {key} to the upload cache: {e}')
+
+    def hash_for(self, file_path, stat):
+        """Given a file path and its os.stat() result, returns the SHA-256 remembered for this exact version of the file, or None."""
+        the_hash = self._get(self.hashes, self._stat_key(file_path, stat), 'hash')
+        self.counters['hash_hits' if the_hash else 'hash_misses'] += 1
+        return the_hash
+
+    def remember_hash(self, file_path, stat, the_hash):
+        """Remembers the SHA-256 of this version of a file. Returns None."""
+        self._set(self.hashes, self._stat_key(file_path, stat), {'hash': the_hash, 'path': os.path.realpath(file_path)})
+
+    def url_for(self, the_hash):
+        """Returns the URL that content with this SHA-256 was uploaded to, or None."""
+        url = self._get(self.urls, the_hash, 'url')
+        self.counters['url_hits' if url else 'url_misses'] += 1
+        return url
+
+    def remember_url(self, the_hash, url):
+        """Remembers the URL that content with this SHA-256 was uploaded to. Returns None."""
+        self._set(self.urls, the_hash, {'url': url})
+
+    def stats(self):
+        """Returns a dict of the url_hits/url_misses/hash_hits/hash_misses counters."""
+        return dict(self.counters)
+
+    def __str__(self):
+        return f'moobius.UploadCache(implementation={self.implementation}, urls={self.urls})'
+    def __repr__(self):
+        return self.__str__()
@@ -2,14 +2,29 @@
 # Websockets, unlike https, have seperate "send" and "recieve" functions.
 # This module is designed to be used by the Moobius service.
 
-import asyncio, uuid, json, time
+import asyncio, uuid, json, time, random
 import websockets, dataclasses
 from loguru import logger
 
 from moobius import json_utils
+from moobius.network import outbound_queue
+from moobius.network.outbound_queue import OutboundQueue, OutboundItem
+from moobius.network import inbound_dispatcher
+from moobius.network.inbound_dispatcher import InboundDispatcher
+from moobius.network.ack_tracker import AckTracker, AckRejectedException
+from moobius.network.outbound_journal import OutboundJournal
+from moobius.network import ws_compression
+from moobius.network.liveness import LivenessMonitor
+from moobius.network import payload_builders
+from moobius.network.traffic_log import TrafficLogger, SizeCounters, payload_kind, frame_type, frame_size
 import moobius.types as types
 from moobius.types import *
 
+DISCONNECTED = "disconnected" # Connection state: no usable socket; the next connect() will open one.
+CONNECTING = "connecting" # Connection state: connect() is opening the socket (with backoff between failed attempts).
+AUTHENTICATING = "authenticating" # Connection state: the socket is open and on_connect() (the login) is running.
+READY = "ready" # Connection state: logged in, the outbound queue is being sent.
+
 
 def asserted_dataclass_asdict(x, the_class):
     """
@@ -52,7 +67,7 @@ class WSClient:
     """
 
     ############################## Standard socket interaction ########################
-    def __init__(self, ws_server_uri, on_connect=None, handle=None, report_str=None):
+    def __init__(self, ws_server_uri, on_connect=None, handle=None, report_str=None, batch_max_frames=1, batch_max_bytes=1<<20, batch_max_delay=0.0, lane_weights=None, max_queue_size=None, overflow_policy="block", coalesce_updates=True, json_codec="auto", reconnect_base_delay=0.5, reconnect_max_delay=30.0, inbound_max_workers=16, inbound_max_pending=1024, inbound_order_by="channel", ack_timeout=10.0, ack_retries=2, journal_dir=None, journal_fsync="batch", journal_segment_bytes=8<<20, traffic_log=None, compression=True, compression_window_bits=None, compression_threshold=0, compression_level=None, liveness_interval=5.0, liveness_timeout=4.0, liveness_max_missed=2, recv_timeout=256):
         """
         Initializes a WSClient object.
 
@@ -62,9 +77,75 @@ class WSClient:
           on_connect: function
             The function to be called when the websocket is connected.
           handle: function
-            The function to be called when a message is received.
+            The function to be called when a message is received. It is given the decoded payload dict (or the raw string if it is not valid JSON).
           report_str: str
             The string printed with each printout (generally user mode vs service mode).
+          batch_max_frames=1: int
+            Opt-in batching: the queue consumer drains up to this many ready messages and writes them back-to-back.
+            1 (the default) sends one message at a time.
+          batch_max_bytes=1<<20: int
+            A batch stops growing once it holds this many characters.
+          batch_max_delay=0.0: float
+            Seconds to linger for more messages when the queue runs dry before a batch is full. 0 means only take what is already queued.
+          lane_weights=None: dict
+            Overrides the weighted round-robin between the "interactive" and "bulk" lanes of the outbound queue, such as {"interactive": 8, "bulk": 1}.
+            The "control" lane (logins and heartbeats) is always sent first.
+          max_queue_size=None: int
+            Bounds the outbound queue (control messages excluded) so that a long disconnect cannot use unlimited memory. None is unbounded.
+          overflow_policy="block": str
+            What to do when the queue is full: "block" makes send() wait, "drop_oldest" discards the oldest bulk/interactive message,
+            "collapse" discards updates superseded by a newer queued update for the same (subtype, channel_id, recipients) and otherwise drops the oldest.
+            Depth and drop counters are available from self.outbound_queue.stats().
+          coalesce_updates=True: bool
+            Full-state updates (send_characters, send_buttons, send_menu, send_style, update_canvas) replace a not-yet-sent update
+            for the same (subtype, channel_id, recipients) in place, so only the newest state is sent.
+          json_codec="auto": str
+            The JSON codec for outbound and inbound payloads: "orjson", "msgspec", "json", or "auto" (the fastest one installed). See json_utils.get_codec.
+          reconnect_base_delay=0.5: float
+            Seconds to wait after the first failed connection attempt. Doubles with each further failure, with random jitter.
+          reconnect_max_delay=30.0: float
+            The cap on the wait between connection attempts.
+          inbound_max_workers=16: int
+            How many received payloads can be handled concurrently.
+          inbound_max_pending=1024: int
+            How many received payloads can be waiting or running before receive() stops reading from the socket. None is unbounded.
+          inbound_order_by="channel": str
+            Payloads with the same "channel" (channel_id) or "sender" are handled one at a time in the order received, other payloads run in parallel.
+          ack_timeout=10.0: float
+            Default seconds send(..., wait_ack=True) waits for the server to acknowledge before re-sending.
+          ack_retries=2: int
+            Default number of re-sends after an acknowledgement times out.
+          journal_dir=None: str
+            Opt-in durable queue: a folder where queued (non-control) messages are journaled until the server accepts them, so that they survive a restart.
+            Messages left over from a previous run are re-queued, in order, on the first connect(), and messages sent but not acknowledged before
+            a reconnect are sent again (at-least-once). Frames without a "request_id" are never acknowledged, so they are only journaled until sent (at-most-once).
+            A message the server rejects (a "copy" with a False status) is re-sent up to ack_retries times and otherwise kept for the next run.
+            Use a different folder for each WSClient.
+          journal_fsync="batch": str
+            "always" fsyncs every message before send() returns, "batch" writes once per event loop iteration and fsyncs in a worker thread, "never" leaves it to the OS.
+          journal_segment_bytes=8<<20: int
+            Size at which the journal starts a new segment file. Fully sent segments are deleted.
+          traffic_log=None: dict
+            Keyword arguments for the TrafficLogger which logs the frames sent and received, such as {"level": "DEBUG", "max_chars": 512, "sample_rates": {"update": 0.1}}.
+            The Moobius class fills this in from log_config["traffic_log"].
+          compression=True: bool
+            Negotiate permessage-deflate with the server. Saves bandwidth on large canvas/buttons payloads at some CPU cost.
+          compression_window_bits=None: int
+            The deflate window (8 to 15) used for sent messages. Smaller uses less memory but compresses less. None uses 15.
+          compression_threshold=0: int
+            Messages shorter than this many bytes are sent uncompressed, which saves CPU on heartbeats and short chats.
+          compression_level=None: int
+            The zlib level (1 fastest to 9 smallest) for sent messages. None uses the websockets default.
+            Frame and byte counters, before and after compression, are available from self.traffic_stats().
+          liveness_interval=5.0: float
+            Seconds without receiving anything before the socket is pinged (websocket ping/pong, not the platform heartbeat).
+            None or 0 turns the liveness monitor off and uses the websockets library's built-in keepalive instead.
+          liveness_timeout=4.0: float
+            The longest wait for a pong. The actual wait adapts to the measured round-trip time, see self.liveness.stats().
+          liveness_max_missed=2: int
+            How many missed pongs in a row count as a dead connection, which is then dropped and reconnected.
+          recv_timeout=256: float
+            Seconds receive() waits for anything before giving up on the connection. A fallback for when the liveness monitor is off.
 
         Example:
           >>> ws_client = WSClient("ws://localhost:8765", on_connect=on_connect, handle=handle)
@@ -77,77 +158,403 @@ class WSClient:
         async def _default_handle(self, message): """Accepts a message. Returns None."""; logger.debug(f"{message}")
         self.on_connect = on_connect or _default_on_connect # THe SDK sets on_connect to service or user login.
         self.handle = handle or _default_handle
-        self.outbound_queue = asyncio.Queue()
+        self.journal = OutboundJournal(journal_dir, journal_fsync, journal_segment_bytes) if journal_dir else None
+        self._journal_replayed = False
+        self.outbound_queue = OutboundQueue(lane_weights, max_queue_size, overflow_policy, coalesce_updates, self.journal)
         self.outbound_queue_running = False
         self.timeout = 16 # Connection and socket sending timeout (seems to hang every so often).
-        self.is_connected = False # Flag to indicate if the service is connected. Can only consume from the queue if connected.
+        self.state = DISCONNECTED # One of DISCONNECTED, CONNECTING, AUTHENTICATING, READY. Can only consume from the queue if READY.
+        self.ready_event = asyncio.Event() # Set while self.state is READY.
+        self._connect_lock = asyncio.Lock() # Makes sure only one connect() runs at a time.
+        self.reconnect_base_delay = reconnect_base_delay
+        self.reconnect_max_delay = reconnect_max_delay
         self.report_str = report_str if report_str else '' # Debug information, such is user vs service mode.
+        self.codec = json_utils.get_codec(json_codec)
+        self.traffic_log = TrafficLogger(**(traffic_log or {}))
+        self.size_counters = SizeCounters()
+        self.wire_counters = ws_compression.new_wire_counters()
+        self._connect_kwargs = ws_compression.connect_kwargs(compression, compression_window_bits, compression_threshold, compression_level, self.wire_counters)
+        self.liveness = LivenessMonitor(self, liveness_interval, liveness_timeout, liveness_max_missed) if liveness_interval else None
+        if self.liveness is not None:
+            self._connect_kwargs['ping_interval'] = None # The liveness monitor does the pinging.
+        self.recv_timeout = recv_timeout
+        if inbound_order_by not in inbound_dispatcher.ORDERINGS:
+            raise Exception(f'Unknown inbound_order_by {inbound_order_by}, must be one of {inbound_dispatcher.ORDERINGS}')
+        self.inbound_order_by = inbound_order_by
+        self.inbound_dispatcher = InboundDispatcher(self.safe_handle, inbound_max_workers, inbound_max_pending)
+        self._unacked = {} # request_id => journaled items that were written to the socket and are waiting for the acknowledgement.
+        self._rejections = {} # request_id => how many times the server rejected a journaled message that is being re-sent.
+        self.acks = AckTracker(on_ack=self._release_acked) # Only requests sent with wait_ack=True are awaited.
+        self.ack_timeout = ack_timeout
+        self.ack_retries = ack_retries
+        self.batch_max_frames = max(1, int(batch_max_frames))
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_max_delay = batch_max_delay
+
+    @property
+    def is_connected(self):
+        """True if the socket is logged in and ready to send (self.state is READY)."""
+        return self.state == READY
+
+    def _set_state(self, state):
+        """Sets self.state and keeps self.ready_event in sync. Returns None."""
+        if state != self.state:
+            logger.debug(f'WSClient{self.report_str} state {self.state} -> {state}')
+        self.state = state
+        if state == READY:
+            self.ready_event.set()
+        else:
+            self.ready_event.clear()
+
+    def _mark_disconnected(self, websocket, abort=False):
+        """Called when sending or receiving on websocket fails. Returns None.
+        Only the current socket can be marked, so that a failure noticed late on an old socket does not undo a fresh reconnect.
+        With abort=True (the connection is known to be dead) the transport is dropped at once instead of waiting on a closing handshake,
+        so that a receive() blocked on it wakes up right away."""
+        if websocket is not self.websocket or self.state not in [AUTHENTICATING, READY]:
+            return
+        self._set_state(DISCONNECTED)
+        if abort:
+            try:
+                websocket.transport.abort()
+            except Exception:
+                pass
+        async def _close_quietly():
+            """Closes the dead socket in the background so that its resources are freed. Returns None."""
+            try:
+                await time_out_wrap(websocket.close(), self.timeout)
+            except Exception:
+                pass
+        asyncio.get_running_loop().create_task(_close_quietly())
+
+    def _backoff_delay(self, attempt):
+        """Given how many connection attempts have failed in a row, returns how long to sleep. Exponential with jitter, capped at self.reconnect_max_delay."""
+        delay = min(self.reconnect_max_delay, self.reconnect_base_delay * 2**attempt)
+        return delay/2 + random.uniform(0, delay/2)
 
     async def connect(self): # Called from sdk.start() and from other functions when trying to reconnect.
         """Connects to the websocket server. Call after self.authenticate(). Returns None.
-        Keeps trying if it fails!"""
-        while True:
+        Keeps trying if it fails, waiting longer between each attempt!
+        Only one connection is ever being made at a time: concurrent callers wait for the first one and then return."""
+        async with self._connect_lock:
+            if self.state == READY: # Someone else reconnected while this call was waiting for the lock.
+                return
+            self._set_state(CONNECTING)
+            attempt = 0
+            while True:
+                try:
+                    logger.info('Attempting to (re)connect...')
+                    self.websocket = await time_out_wrap(websockets.connect(self.ws_server_uri, **self._connect_kwargs), timeout=self.timeout)
+                    logger.info('Reconnected sucessfully!')
+                    break
+                except Exception as e:
+                    delay = self._backoff_delay(attempt)
+                    attempt += 1
+                    logger.warning(f'{e} {type(e)}; Will keep trying in this connection loop, attempt {attempt} failed, retrying in {delay:.2f}s.')
+                    await asyncio.sleep(delay)
+            if self.journal is not None and not self._journal_replayed:
+                self._replay_journal()
+            self._resend_unacked()
+            self._set_state(AUTHENTICATING)
             try:
-                logger.info('Attempting to (re)connect...')
-                self.websocket = await time_out_wrap(websockets.connect(self.ws_server_uri), timeout=self.timeout)
-                logger.info('Reconnected sucessfully!')
-                self.is_connected = True
+                await self.on_connect()
+            except Exception:
+                self._mark_disconnected(self.websocket)
+                raise
+            self._set_state(READY)
+            if self.liveness is not None:
+                self.liveness.start()
+
+    def _replay_journal(self):
+        """Puts the messages a previous run journaled but never sent at the front of the outbound queue. Called once, on the first connect(). Returns None."""
+        self._journal_replayed = True
+        items = []
+        for seq, lane, frame in self.journal.recovered:
+            try:
+                request_id = self.codec.loads(frame).get('request_id')
+            except Exception:
+                request_id = None
+            items.append(OutboundItem(frame, lane, None, seq, hold=bool(request_id), request_id=request_id))
+        self.journal.recovered = []
+        if items:
+            logger.info(f'Re-sending {len(items)} messages from the outbound journal.')
+            self.outbound_queue.put_front(items)
+
+    def _await_acks(self, items):
+        """Call just before writing items to the socket. Journaled items with a request_id are kept until _release_acked() sees the acknowledgement. Returns None."""
+        for item in items:
+            if item.seq is not None and item.request_id:
+                waiting = self._unacked.setdefault(item.request_id, [])
+                if item not in waiting:
+                    waiting.append(item)
+
+    def _unawait_acks(self, items):
+        """Undoes _await_acks() for items that failed to send and go back into the queue. Returns None."""
+        for item in items:
+            waiting = self._unacked.get(item.request_id)
+            if waiting and item in waiting:
+                waiting.remove(item)
+                if not waiting:
+                    del self._unacked[item.request_id]
+
+    def _release_acked(self, request_id, accepted):
+        """
+        Called by self.acks for every acknowledgement. Returns True if journaled items with this request_id were waiting for it.
+        If the server accepted them they are committed. If it rejected them they are sent again after a backoff, up to self.ack_retries times,
+        after which they are left in the journal so that the next run re-sends them. Items awaited by send(..., wait_ack=True) are left to its own re-sending.
+        """
+        if request_id not in self._unacked:
+            return False
+        if not accepted and request_id in self.acks.pending:
+            return True
+        items = self._unacked.pop(request_id)
+        if accepted:
+            self._rejections.pop(request_id, None)
+            for item in items:
+                item.hold = False
+            self.outbound_queue.done(items)
+            return True
+        n_rejected = self._rejections.get(request_id, 0) + 1
+        if n_rejected > self.ack_retries:
+            self._rejections.pop(request_id, None)
+            logger.error(f'The server rejected request {request_id} {n_rejected} times, keeping it in the outbound journal for the next run.')
+            return True
+        self._rejections[request_id] = n_rejected
+        delay = self._backoff_delay(n_rejected-1)
+        logger.warning(f'The server rejected request {request_id}, re-sending in {delay:.2f}s (retry {n_rejected}/{self.ack_retries}).')
+        asyncio.get_running_loop().call_later(delay, self.outbound_queue.put_front, items)
+        return True
+
+    def _resend_unacked(self):
+        """Puts the journaled items that were sent on the lost connection but never acknowledged back at the front of the outbound queue.
+        Items awaited by send(..., wait_ack=True) are left to its own re-sending. Returns None."""
+        items = [item for request_id, waiting in self._unacked.items() if request_id not in self.acks.pending for item in waiting]
+        self._unacked = {}
+        if items:
+            logger.info(f'Re-sending {len(items)} journaled messages that were not acknowledged before the connection was lost.')
+            self.outbound_queue.put_front(sorted(items, key=lambda item: item.seq))
+
+    async def wait_until_ready(self):
+        """Waits until the socket is READY, starting a connect() if nobody else is. Returns None."""
+        while self.state != READY:
+            if self.state == DISCONNECTED:
+                await self.connect()
+            else:
+                await self.ready_event.wait()
+
+    async def _drain_batch(self, first_item):
+        """Given an OutboundItem already taken from self.outbound_queue, takes more ready items until the batch limits are hit.
+        Waits up to self.batch_max_delay for stragglers if the queue runs dry. Returns the list of items."""
+        batch = [first_item]
+        n_chars = len(first_item.frame)
+        deadline = None
+        while len(batch) < self.batch_max_frames and n_chars < self.batch_max_bytes:
+            if not self.outbound_queue.empty():
+                item = self.outbound_queue.get_nowait()
+            elif self.batch_max_delay > 0:
+                loop = asyncio.get_running_loop()
+                if deadline is None:
+                    deadline = loop.time() + self.batch_max_delay
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.outbound_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            else:
                 break
-            except Exception as e:
-                logger.warning(f'{e} {type(e)}; Will keep trying in this connection loop.')
-        await self.on_connect()
+            batch.append(item)
+            n_chars += len(item.frame)
+        return batch
+
+    async def _send_batch(self, batch):
+        """Writes a list of OutboundItems to the socket back-to-back under a single timeout and logs them as one record.
+        On failure the unsent items are put back onto the queue. Returns None."""
+        n_sent = 0
+        websocket = self.websocket
+        async def _write_all():
+            nonlocal n_sent
+            for item in batch:
+                await websocket.send(item.frame)
+                n_sent += 1
+        self._await_acks(batch)
+        try:
+            await time_out_wrap(_write_all(), self.timeout)
+            self.outbound_queue.done(batch)
+            for item in batch:
+                self.size_counters.add_sent(item.kind or frame_type(item.frame), frame_size(item.frame))
+            self.traffic_log.sent_batch(len(batch), sum(len(item.frame) for item in batch), self.report_str)
+        except Exception as e:
+            logger.warning(f'Failed to send data after {n_sent}/{len(batch)} messages of a batch, the connection seems to be lost: {e}; {type(e)}.')
+            self._mark_disconnected(websocket)
+            self.outbound_queue.done(batch[:n_sent])
+            self._unawait_acks(batch[n_sent:])
+            self.outbound_queue.put_front(batch[n_sent:])
 
     async def _queue_consume(self):
         """Consumes tasks from an internal asyncio queue. Returns Never."""
         while True:
-            message = await self.outbound_queue.get()
-            if not self.is_connected:
-                await self.connect() # This will likely fill the queue more.
+            item = await self.outbound_queue.get()
+            if self.state != READY:
+                # Put it back and wait: the reconnect queues a login, which must be sent before anything else.
+                self.outbound_queue.put_front([item])
+                await self.wait_until_ready()
+                continue
+            if self.batch_max_frames > 1:
+                await self._send_batch(await self._drain_batch(item))
+                continue
+            websocket = self.websocket
+            self._await_acks([item])
             try:
-                await time_out_wrap(self.websocket.send(message), self.timeout)
-                logger.opt(colors=True).info(f"<fg 128,0,240>Sent to socket{self.report_str}: {str(message).replace('<', '&lt;').replace('>', '&gt;')}</>")
+                await time_out_wrap(websocket.send(item.frame), self.timeout)
+                self.outbound_queue.done([item])
+                self.size_counters.add_sent(item.kind or frame_type(item.frame), frame_size(item.frame))
+                self.traffic_log.sent(item.frame, self.report_str)
             except Exception as e:
                 logger.warning(f'Failed to send data, the connection seems to be lost: {e}; {type(e)}.')
-                self.is_connected = False # No longer connected!
-                # Put back the data since it failed to send. TODO: Does this change the order in a harmful way?
-                await self.outbound_queue.put(message)
+                self._mark_disconnected(websocket)
+                self._unawait_acks([item])
+                self.outbound_queue.put_front([item]) # Put back the data at the front of its lane since it failed to send.
 
-    async def send(self, message):
+    async def send(self, message, *, lane=None, wait_ack=False, ack_timeout=None, ack_retries=None):
         """
         Accepts a dict-valued message (or JSON string). Adds the message to self.outbound_queue for sending to the server.
         Note: Call this and other socket functions after self.authenticate()
+        The optional lane ("control", "interactive", or "bulk") overrides the priority lane, which is otherwise inferred from message['type'].
+        String messages default to the "interactive" lane.
         Returns None. If the server responds to the message it will be detected in the self.recieve() loop.
+        With a journal_dir, a message with a "request_id" stays journaled until the server acknowledges it; one without stays only until it is written to the socket.
+
+        With wait_ack=True (dict messages with a "request_id" only) this waits until the server accepts the request and returns the acknowledgement body.
+        If no acknowledgement arrives within ack_timeout seconds, or the server rejects the message (a "copy" with a False status), the same message is sent again,
+        up to ack_retries times (at-least-once delivery), after which an asyncio.TimeoutError or an AckRejectedException is raised. The ack_timeout and ack_retries default to the values given on construction.
+        Acknowledged messages are never coalesced with later updates. Round-trip times are available from self.acks.stats().
+
+        Example of waiting on a builder's message:
+          >>> message = await ws_client.message_down(..., dry_run=True)
+          >>> await ws_client.send(message, wait_ack=True)
+        """
+        key = None
+        request_id = None
+        kind = None
+        if type(message) is dict:
+            lane = lane or outbound_queue.lane_of(message)
+            kind = payload_kind(message)
+            key = outbound_queue.supersede_key(message)
+            request_id = message.get('request_id')
+            message = self.codec.dumps(message) # Dataclasses are serialized directly.
+        elif type(message) is not str:
+            raise Exception("must send a string or dict-valued message into ws_client.send")
+        return await self._enqueue(message, lane or outbound_queue.INTERACTIVE, key, kind, request_id, wait_ack, ack_timeout, ack_retries)
+
+    async def broadcast(self, message, recipients_list, *, lane=None):
+        """
+        Sends copies of one dict-valued message to many recipient groups, for example the same canvas to every per-user group.
+        The message is serialized only once; each copy gets its own "request_id" and body["recipients"] spliced into the JSON string.
+
+        Parameters:
+          message: A dict-valued message with a "body", usually from a builder called with dry_run=True.
+          recipients_list: A list of group id strings. Each one gets its own copy of the message.
+          lane=None: Overrides the priority lane, as in send().
+
+        Returns: The list of request_ids, one per recipient group.
+
+        Example:
+          >>> message = await ws_client.send_buttons(buttons, service_id, channel_id, group_ids[0], dry_run=True)
+          >>> await ws_client.broadcast(message, group_ids)
         """
+        types.assert_strs(*recipients_list)
+        lane = lane or outbound_queue.lane_of(message)
+        kind = payload_kind(message)
+        base_key = outbound_queue.supersede_key(message)
+        request_ids = [str(uuid.uuid4()) for _ in recipients_list]
+        template = payload_builders.FrameTemplate(message, ['request_id'], ['body', 'recipients'], dumps=self.codec.dumps)
+        for request_id, recipients in zip(request_ids, recipients_list):
+            key = None if base_key is None else (base_key[0], base_key[1], recipients)
+            await self._enqueue(template.fill(request_id, recipients), lane, key, kind, request_id)
+        return request_ids
+
+    async def _enqueue(self, message, lane, key, kind, request_id, wait_ack=False, ack_timeout=None, ack_retries=None):
+        """Puts an already serialized message onto self.outbound_queue, waiting for the acknowledgement if wait_ack. See send(), which most code should use.
+        Returns None, or the acknowledgement body if wait_ack."""
         if not self.outbound_queue_running: # This must be inside an async, and __init__ is not async.
             loop = asyncio.get_running_loop()
             self.outbound_queue_running = True
             loop.create_task(self._queue_consume())
-        if type(message) is dict:
-            message = self.dumps(message) # This converts dataclasses into dicts.
-        elif type(message) is not str:
-            raise Exception("must send a string or dict-valued message into ws_client.send")
-        await self.outbound_queue.put(message)
+        if not wait_ack:
+            await self.outbound_queue.put(OutboundItem(message, lane, key, hold=bool(request_id), kind=kind, request_id=request_id))
+            return
+        if not request_id:
+            raise Exception("wait_ack=True needs a dict-valued message with a request_id")
+        ack_timeout = self.ack_timeout if ack_timeout is None else ack_timeout
+        ack_retries = self.ack_retries if ack_retries is None else ack_retries
+        items = []
+        error = None
+        try:
+            for attempt in range(ack_retries+1):
+                if attempt > 0:
+                    self.acks.counters['retries'] += 1
+                    logger.warning(f'{error}; re-sending (retry {attempt}/{ack_retries}).')
+                future = self.acks.expect(request_id) # The same future while unanswered, so a late acknowledgement of an earlier copy still counts.
+                item = OutboundItem(message, lane, None, hold=True, kind=kind, request_id=request_id) # No key: a coalesced frame would carry someone else's request_id.
+                items.append(item)
+                await self.outbound_queue.put(item) # Held in the journal (if any) until acknowledged or given up on.
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), ack_timeout)
+                except asyncio.TimeoutError:
+                    error = asyncio.TimeoutError(f'No acknowledgement for request {request_id} after {ack_timeout}s')
+                except AckRejectedException as e:
+                    error = e
+                    if attempt < ack_retries:
+                        await asyncio.sleep(self._backoff_delay(attempt)) # Give the server a moment (such as for a login to go through) before re-sending.
+            if isinstance(error, AckRejectedException):
+                raise error
+            self.acks.counters['timeouts'] += 1
+            raise asyncio.TimeoutError(f'No acknowledgement for request {request_id} after {ack_retries+1} attempts.')
+        finally:
+            self.acks.discard(request_id)
+            self._unawait_acks(items)
+            for item in items:
+                item.hold = False
+            self.outbound_queue.done(items)
 
     async def receive(self):
         """
         Waits in a loop for messages from the websocket server or from the wand queue. Never returns.
         Reconnectes if the connection fails or self.websocket.recv() stops getting anything (no heartbeats nor messages).
+        Messages are handed to self.inbound_dispatcher, which preserves the order within a channel and waits when too many are pending.
         """
 
         while True:
-            if not self.is_connected:
-                await self.connect()
+            if self.state != READY:
+                await self.wait_until_ready()
+            websocket = self.websocket
             try:
-                message = await time_out_wrap(self.websocket.recv(), 256) # BIG timeout so heartbeats can have time.
-                logger.opt(colors=True).info(f"<yellow>{self.report_str} {str(message).replace('<', '&lt;').replace('>', '&gt;')}</yellow>")
-                asyncio.create_task(self.safe_handle(message))
+                message = await time_out_wrap(websocket.recv(), self.recv_timeout) # BIG timeout so heartbeats can have time.
+                if self.liveness is not None:
+                    self.liveness.note_received()
             except Exception as e:
                 logger.warning(f"WSClient.receive() failed; the connection seems to be no longer: {e}; {type(e)}")
-                self.is_connected = False # Will connect next loop iteration.
+                self._mark_disconnected(websocket) # Will connect next loop iteration.
+                continue
+            try:
+                payload = self.codec.loads(message) # Decoded once here so that it can be keyed; the handler gets the dict.
+            except Exception:
+                payload = message
+            self.traffic_log.received(message, self.report_str, payload.get('type') if type(payload) is dict else None)
+            self.size_counters.add_received(payload_kind(payload) if type(payload) is dict else 'unknown', frame_size(message))
+            self.acks.resolve(payload) # Resolved here rather than in a worker so that the round-trip time is not inflated by the handler backlog.
+            await self.inbound_dispatcher.submit(payload, inbound_dispatcher.order_key(payload, self.inbound_order_by))
+
+    def traffic_stats(self):
+        """Returns a dict with "payloads": frames and bytes sent/received per payload kind (before compression),
+        and "wire": total bytes before and after compression (zero if compression is off)."""
+        return {'payloads': self.size_counters.stats(), 'wire': dict(self.wire_counters)}
 
     async def safe_handle(self, message):
         """
-        Accepts a string-valued message from the websocket server. Returns None.
+        Accepts a decoded message (or the raw string if it was not valid JSON) from the websocket server. Returns None.
         Handles it with self.handle, which is specified on construction, catching errors.
         """
         try:
@@ -604,6 +1011,34 @@ class WSClient:
             await self.send(message)
         return message
 
+    async def send_message_up(self, user_id, service_id, channel_id, recipients, subtype, content, context=None, *, wait_ack=False):
+        """
+        The fast path of message_up(): same arguments (except dry_run), but the message is written straight to a JSON string by a precompiled
+        builder (see payload_builders) without building a dict first. Use this for high message rates.
+        Returns the request_id of the message (or None if there are no recipients), or the acknowledgement body if wait_ack.
+        """
+        if not recipients:
+            return None
+        types.assert_strs(user_id, service_id, channel_id, recipients, subtype)
+        request_id = str(uuid.uuid4())
+        frame = payload_builders.builder_for(types.MESSAGE_UP, subtype).build(request_id, user_id, service_id, channel_id, recipients, content, int(time.time() * 1000), context, None, self.codec.dumps)
+        ack = await self._enqueue(frame, outbound_queue.INTERACTIVE, None, subtype, request_id, wait_ack)
+        return ack if wait_ack else request_id
+
+    async def send_message_down(self, user_id, service_id, channel_id, recipients, subtype, content, sender, context=None, *, wait_ack=False):
+        """
+        The fast path of message_down(): same arguments (except dry_run), but the message is written straight to a JSON string by a precompiled
+        builder (see payload_builders) without building a dict first. Use this for high message rates.
+        Returns the request_id of the message (or None if there are no recipients), or the acknowledgement body if wait_ack.
+        """
+        if not recipients:
+            return None
+        types.assert_strs(user_id, service_id, channel_id, recipients, subtype)
+        request_id = str(uuid.uuid4())
+        frame = payload_builders.builder_for(types.MESSAGE_DOWN, subtype).build(request_id, None, service_id, channel_id, recipients, content, int(time.time() * 1000), context, sender, self.codec.dumps)
+        ack = await self._enqueue(frame, outbound_queue.INTERACTIVE, None, subtype, request_id, wait_ack)
+        return ack if wait_ack else request_id
+
     ############################# Sending UI interactions ###################################
     async def send_button_click(self, button_id, bottom_button_id, button_args, channel_id, user_id, *, dry_run=False):
         """
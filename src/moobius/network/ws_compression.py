@@ -0,0 +1,84 @@
+# permessage-deflate settings for the WSClient socket, and counters of how many bytes go over the wire.
+# Small frames (heartbeats, short chats) gain nothing from compression, so frames below a threshold are sent uncompressed,
+# which the extension allows on a per-message basis. Large canvas/buttons payloads with repeated HTML compress well.
+# This module is designed to be used by the WSClient.
+
+from websockets import frames
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory, PerMessageDeflate
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """(This class is for internal use). permessage-deflate which sends messages shorter than min_size bytes uncompressed and counts the bytes on the wire."""
+
+    def __init__(self, *args, min_size=0, counters=None, **kwargs):
+        """Accepts the PerMessageDeflate arguments, the min_size in bytes, and the dict to count into."""
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        self.counters = counters if counters is not None else new_wire_counters()
+
+    def encode(self, frame):
+        """Compresses an outgoing frame unless it is a short, unfragmented message. Returns the frame to write."""
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is not frames.OP_CONT and frame.fin and len(frame.data) < self.min_size:
+            self.counters['frames_out_uncompressed'] += 1
+            self.counters['raw_bytes_out'] += len(frame.data)
+            self.counters['wire_bytes_out'] += len(frame.data)
+            return frame
+        encoded = super().encode(frame)
+        self.counters['raw_bytes_out'] += len(frame.data)
+        self.counters['wire_bytes_out'] += len(encoded.data)
+        return encoded
+
+    def decode(self, frame, *, max_size=None):
+        """Decompresses an incoming frame (if it was compressed) and counts its size. Returns the decoded frame."""
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        decoded = super().decode(frame, max_size=max_size)
+        self.counters['wire_bytes_in'] += len(frame.data)
+        self.counters['raw_bytes_in'] += len(decoded.data)
+        return decoded
+
+
+class ThresholdDeflateFactory(ClientPerMessageDeflateFactory):
+    """(This class is for internal use). Negotiates permessage-deflate like the websockets default, but builds a ThresholdPerMessageDeflate."""
+
+    def __init__(self, min_size=0, counters=None, **kwargs):
+        """Accepts the min_size in bytes, the dict to count into (shared by every connection), and the ClientPerMessageDeflateFactory arguments."""
+        super().__init__(**kwargs)
+        self.min_size = min_size
+        self.counters = counters if counters is not None else new_wire_counters()
+
+    def process_response_params(self, params, accepted_extensions):
+        """Returns a ThresholdPerMessageDeflate configured by the server's response."""
+        negotiated = super().process_response_params(params, accepted_extensions)
+        return ThresholdPerMessageDeflate(negotiated.remote_no_context_takeover, negotiated.local_no_context_takeover,
+                                          negotiated.remote_max_window_bits, negotiated.local_max_window_bits,
+                                          negotiated.compress_settings, min_size=self.min_size, counters=self.counters)
+
+
+def new_wire_counters():
+    """Returns a zeroed dict of the counters ThresholdPerMessageDeflate keeps."""
+    return {'raw_bytes_out':0, 'wire_bytes_out':0, 'frames_out_uncompressed':0, 'raw_bytes_in':0, 'wire_bytes_in':0}
+
+
+def connect_kwargs(enabled=True, window_bits=None, threshold=0, level=None, counters=None):
+    """
+    Returns the compression kwargs for websockets.connect().
+
+    Parameters:
+      enabled=True: False turns compression off.
+      window_bits=None: The client_max_window_bits to use (8 to 15, smaller uses less memory per connection but compresses less). None uses the default of 15.
+      threshold=0: Messages shorter than this many bytes are sent uncompressed.
+      level=None: The zlib compression level (1 is fastest, 9 is smallest). None uses the websockets default.
+      counters=None: Optional dict from new_wire_counters() that the extension counts into.
+    """
+    if not enabled:
+        return {'compression': None}
+    compress_settings = {'memLevel': 5} # The websockets default.
+    if level is not None:
+        compress_settings['level'] = level
+    factory = ThresholdDeflateFactory(min_size=threshold, counters=counters,
+                                      client_max_window_bits=window_bits if window_bits else True,
+                                      compress_settings=compress_settings)
+    return {'compression': None, 'extensions': [factory]} # compression=None so websockets does not add its own deflate extension as well.
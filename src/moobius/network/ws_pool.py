@@ -0,0 +1,52 @@
+# Spreads one service over several websocket connections.
+# Each channel always uses the same connection (chosen by a hash of the channel_id), so messages within a channel keep their order,
+# while a slow send or a stalled TCP connection only holds up the channels on that one connection.
+# This module is designed to be used by the Moobius class.
+
+import asyncio, zlib
+
+
+class WSClientPool:
+    """
+    (This class is for internal use).
+    A fixed list of WSClients, each separately connected and logged in. Pick the client for a channel with for_channel().
+    Messages that do not belong to a channel go on the first client.
+    """
+
+    def __init__(self, clients):
+        """Accepts a non-empty list of WSClients."""
+        if not clients:
+            raise Exception('A WSClientPool needs at least one WSClient.')
+        self.clients = list(clients)
+
+    def __len__(self):
+        return len(self.clients)
+
+    def for_channel(self, channel_id):
+        """Returns the WSClient which carries a given channel_id. A None channel_id gets the first client.
+        Uses crc32 rather than hash() so the mapping is the same in every process."""
+        if not channel_id or len(self.clients) == 1:
+            return self.clients[0]
+        return self.clients[zlib.crc32(str(channel_id).encode('utf-8')) % len(self.clients)]
+
+    async def connect(self):
+        """Connects the first client, then the others concurrently. The first one goes alone because its login may create the service. Returns None."""
+        await self.clients[0].connect()
+        await asyncio.gather(*[client.connect() for client in self.clients[1:]])
+
+    async def receive(self):
+        """Runs every client's receive() loop. Never returns."""
+        await asyncio.gather(*[client.receive() for client in self.clients])
+
+    async def heartbeat(self):
+        """Sends a heartbeat on every client. Returns None."""
+        await asyncio.gather(*[client.heartbeat() for client in self.clients])
+
+    def stats(self):
+        """Returns a list with the outbound queue stats of each client, in order."""
+        return [client.outbound_queue.stats() for client in self.clients]
+
+    def __str__(self):
+        return f'moobius.WSClientPool(n_clients={len(self.clients)})'
+    def __repr__(self):
+        return self.__str__()